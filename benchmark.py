@@ -0,0 +1,397 @@
+""" Replay based benchmarks of the flask endpoints and the cluster store
+
+Endpoints: replays recorded (--replay FILE) or synthetic slash command and
+/update traffic through the flask test client, with local stand-ins for
+jenkins and slack, and reports throughput and p50/p95/p99 latency per
+endpoint.
+
+    python benchmark.py endpoints --requests 2000
+    python benchmark.py store --sizes 1000,100000,1000000
+
+A replay file has one JSON request per line:
+    {"method": "POST", "path": "/slack/command", "form": {...}}
+    {"method": "POST", "path": "/update", "json": {...}}
+    {"method": "POST", "path": "/update/batch", "json": [{...}, ...]}
+    {"drain": true}   waits until the queued slash commands are done
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from cluster_record import TIME_FORMAT
+from cluster_store import (PERSISTENCE_JSON, PERSISTENCE_JOURNAL,
+                           PERSISTENCE_SQLITE, SqliteClusterStore,
+                           create_store)
+from local_standins import JenkinsStandIn, SlackClientStandIn
+
+STORE_SIZES = '1000,100000,1000000'
+PERSISTENCE_MODES = ','.join([PERSISTENCE_JSON, PERSISTENCE_JOURNAL,
+                              PERSISTENCE_SQLITE])
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile of sorted samples
+    """
+    if not samples:
+        return 0.0
+    index = max(0, min(len(samples) - 1,
+                       int(round(pct / 100.0 * len(samples))) - 1))
+    return samples[index]
+
+
+def summarize(name, samples, elapsed=None):
+    samples = sorted(samples)
+    elapsed = elapsed if elapsed is not None else sum(samples)
+    return {'name': name, 'count': len(samples),
+            'ops_per_sec': len(samples) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p95_ms': percentile(samples, 95) * 1000,
+            'p99_ms': percentile(samples, 99) * 1000}
+
+
+def print_table(title, rows, out=sys.stdout):
+    out.write('\n{}\n'.format(title))
+    out.write('{:<44} {:>8} {:>12} {:>10} {:>10} {:>10}\n'.format(
+        'name', 'count', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for row in rows:
+        out.write('{name:<44} {count:>8} {ops_per_sec:>12.1f} '
+                  '{p50_ms:>10.3f} {p95_ms:>10.3f} {p99_ms:>10.3f}\n'.format(
+                      **row))
+    out.flush()
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Silence the logging of the code under measurement
+    """
+    logging.disable(logging.WARNING)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def synthetic_traffic(count, users=50, seed=0, update_batch=1):
+    """
+    Slash command and jenkins callback traffic of short lived clusters
+    :param count: approximate number of requests
+    :param update_batch: callbacks sent per /update/batch request, 1 sends
+                         every callback to /update
+    """
+    rnd = random.Random(seed)
+    clusters = []
+    for index in range(max(1, count // 5)):
+        user = 'U{:06d}'.format(rnd.randrange(users))
+        clusters.append((user, 'bench-{}-{}'.format(index, seed)))
+
+    def slash(user, command, text=''):
+        return {'method': 'POST', 'path': '/slack/command',
+                'form': {'command': command, 'user_id': user, 'text': text,
+                         'response_url': ''}}
+
+    def callback(user, name, status):
+        return {'method': 'POST', 'path': '/update',
+                'json': {'user_id': user, 'name': name, 'status': status}}
+
+    def callbacks(status):
+        entries = [callback(user, name, status) for user, name in clusters]
+        for index in range(0, len(entries), update_batch):
+            yield {'method': 'POST', 'path': '/update/batch',
+                   'json': [entry['json'] for entry in
+                            entries[index:index + update_batch]]}
+
+    for user, name in clusters:
+        yield slash(user, '/create_cluster',
+                    'name:{}, type:AWS_ROSA, version:4.12, '
+                    'region:us-east-1'.format(name))
+    yield {'drain': True}
+    if update_batch > 1:
+        yield from callbacks('running')
+    for user, name in clusters:
+        if update_batch <= 1:
+            yield callback(user, name, 'running')
+        yield slash(user, '/clusters')
+        yield slash(user, '/delete_cluster', name)
+    yield {'drain': True}
+    if update_batch > 1:
+        yield from callbacks('delete_success')
+    else:
+        for user, name in clusters:
+            yield callback(user, name, 'delete_success')
+
+
+def load_traffic(path):
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def endpoint_name(entry):
+    if entry.get('form', {}).get('command'):
+        return '{} {}'.format(entry['path'], entry['form']['command'])
+    return entry['path']
+
+
+def setup_server(workdir, persistence, standin, slack_client, workers):
+    """
+    Create the flask app through the factory of cloud_infra_mgmt_server,
+    with jenkins and slack replaced by the local stand-ins
+    :return: server module and flask app
+    """
+    os.environ.setdefault('BOT_TOKEN', 'xoxb-benchmark')
+    os.environ.setdefault('SIGNING_SECRET', 'benchmark')
+    os.environ.setdefault('JENKINS_USER', 'benchmark')
+    os.environ.setdefault('JENKINS_PWD', 'benchmark')
+    os.environ.setdefault('SLACK_TOKEN_VERIFICATION', 'false')
+    import cloud_infra_mgmt_server as server
+
+    with open('config.json') as fp:
+        config_json = json.load(fp)
+    config_json.update({
+        'JENKINS_AWS_CREATE': standin.job_url('create'),
+        'JENKINS_AWS_DELETE': standin.job_url('delete'),
+        'JENKINS_RETRIES': 0,
+        'DB_PERSISTENCE': persistence,
+        'DB_PATH': os.path.join(workdir, 'cluster_info.' + (
+            'db' if persistence == PERSISTENCE_SQLITE else 'json')),
+        'COMMAND_QUEUE_DEPTH': 100000,
+        'COMMAND_WORKERS': workers,
+        'SLACK_COALESCE_WINDOW': 0.05,
+        'SLACK_MIN_POST_INTERVAL': 0,
+        'EXPIRY_LEADER_LOCK': os.path.join(workdir, 'expiry.lock'),
+        'RECONCILE_INTERVAL': 0})
+    config_path = os.path.join(workdir, 'config.json')
+    with open(config_path, 'w') as fp:
+        json.dump(config_json, fp)
+    app = server.create_app(config_path, env_path=None,
+                            slack_client=slack_client)
+    return server, app
+
+
+def stop_server(server):
+    """
+    Stop the background services started by create_app and close the db
+    """
+    server.command_queue.stop()
+    server.notifier.stop()
+    if server.obj_cluster.expiry_scheduler:
+        server.obj_cluster.expiry_scheduler.stop()
+    server.obj_cluster.close()
+
+
+def bench_endpoints(args):
+    standin = JenkinsStandIn(latency=args.jenkins_latency).start()
+    slack_client = SlackClientStandIn(latency=args.slack_latency)
+    with tempfile.TemporaryDirectory(prefix='bench-endpoints-') as workdir:
+        try:
+            server, app = setup_server(workdir, args.persistence, standin,
+                                       slack_client, args.workers)
+            try:
+                latencies, elapsed, drain_time = replay_traffic(
+                    args, server, app, standin)
+            finally:
+                stop_server(server)
+        finally:
+            standin.stop()
+
+    rows = [summarize(name, samples, elapsed)
+            for name, samples in sorted(latencies.items())]
+    rows.append(summarize('all requests',
+                          [sample for samples in latencies.values()
+                           for sample in samples], elapsed))
+    print_table('endpoints ({} persistence, {:.2f}s incl. {:.2f}s waiting '
+                'for queued commands)'.format(args.persistence, elapsed,
+                                              drain_time), rows)
+    print('jenkins builds: {}, response_url posts: {}, slack posts: {}'
+          ''.format(len(standin.builds), len(standin.responses),
+                    len(slack_client.messages)))
+    return rows
+
+
+def replay_traffic(args, server, app, standin):
+    """
+    :return: endpoint -> latencies, elapsed seconds and the seconds spent
+             waiting for queued commands
+    """
+    client = app.test_client()
+    traffic = (load_traffic(args.replay) if args.replay else
+               synthetic_traffic(args.requests, seed=args.seed,
+                                 update_batch=args.update_batch))
+
+    latencies = {}
+    drain_time = 0.0
+    start = time.perf_counter()
+    with quiet():
+        for entry in traffic:
+            if entry.get('drain'):
+                drain_start = time.perf_counter()
+                server.command_queue.join()
+                drain_time += time.perf_counter() - drain_start
+                continue
+            form = entry.get('form')
+            if form is not None and 'response_url' in form:
+                form = dict(form, response_url=standin.response_url)
+            request_start = time.perf_counter()
+            client.open(entry['path'], method=entry.get('method', 'POST'),
+                        data=form, json=entry.get('json'))
+            latencies.setdefault(endpoint_name(entry), []).append(
+                time.perf_counter() - request_start)
+        server.command_queue.join()
+        server.notifier.stop()
+    return latencies, time.perf_counter() - start, drain_time
+
+
+def make_db_data(size, users, seed=0):
+    rnd = random.Random(seed)
+    now = datetime.now()
+    db_data = {}
+    for index in range(size):
+        created = now - timedelta(hours=rnd.randrange(48))
+        db_data.setdefault('U{:06d}'.format(index % users), []).append({
+            'name': 'cluster-{}'.format(index), 'version': '4.12',
+            'type': 'AWS_ROSA', 'status': 'running',
+            'creation_time': created.strftime(TIME_FORMAT),
+            'expiration_time': (created + timedelta(hours=48)).strftime(
+                TIME_FORMAT)})
+    return db_data
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_store_size(persistence, size, args):
+    users = max(1, size // 20)
+    with tempfile.TemporaryDirectory(prefix='bench-store-') as workdir:
+        db_path = os.path.join(workdir, 'cluster_info.' + (
+            'db' if persistence == PERSISTENCE_SQLITE else 'json'))
+        db_data = make_db_data(size, users, args.seed)
+        if persistence == PERSISTENCE_SQLITE:
+            store = SqliteClusterStore(db_path)
+            try:
+                store.import_records(db_data)
+            finally:
+                store.close()
+        else:
+            with open(db_path, 'w') as fp:
+                json.dump(db_data, fp)
+        del db_data
+
+        start = time.perf_counter()
+        store = create_store(persistence, db_path)
+        load_time = time.perf_counter() - start
+        try:
+            results = {'load': [load_time]}
+            results.update(store_operations(store, size, users, args))
+        finally:
+            store.close()
+    return results
+
+
+def store_operations(store, size, users, args):
+    """
+    :return: operation -> durations of the reads and writes on store
+    """
+    rnd = random.Random(args.seed)
+    results = {}
+    names = ['cluster-{}'.format(rnd.randrange(size))
+             for _ in range(args.read_ops)]
+    owners = ['U{:06d}'.format(int(name.split('-')[1]) % users)
+              for name in names]
+    results['get_cluster'] = [timed(store.get_cluster, user, name)
+                              for user, name in zip(owners, names)]
+    results['find_cluster'] = [timed(store.find_cluster, name)
+                               for name in names]
+    results['get_clusters_by_user'] = [
+        timed(store.get_clusters_by_user, user) for user in owners]
+    results['get_expiring_clusters(1h)'] = [
+        timed(store.get_expiring_clusters, 1) for _ in range(args.scan_ops)]
+    results['get_expired_clusters'] = [
+        timed(store.get_expired_clusters) for _ in range(args.scan_ops)]
+    results['snapshot'] = [timed(store.snapshot)
+                           for _ in range(args.scan_ops)]
+    results['update_cluster_attribute'] = [
+        timed(store.update_cluster_attribute, user,
+              {'name': name, 'status': 'deleting'})
+        for user, name in list(zip(owners, names))[:args.write_ops]]
+    new_names = ['bench-new-{}'.format(index)
+                 for index in range(args.write_ops)]
+    results['update_cluster_info'] = [
+        timed(store.update_cluster_info, 'U-bench',
+              {'name': name, 'status': 'creating',
+               'expiration_time': datetime.now().strftime(TIME_FORMAT)})
+        for name in new_names]
+    results['delete_record'] = [timed(store.delete_record, 'U-bench', name)
+                                for name in new_names]
+    return results
+
+
+def bench_store(args):
+    all_rows = []
+    for persistence in args.persistence_modes.split(','):
+        for size in [int(size) for size in args.sizes.split(',')]:
+            with quiet():
+                results = bench_store_size(persistence, size, args)
+            rows = [summarize(op, samples)
+                    for op, samples in results.items()]
+            print_table('cluster store: {} persistence, {} clusters'.format(
+                persistence, size), rows)
+            all_rows.append({'persistence': persistence, 'size': size,
+                             'results': rows})
+    return all_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', dest='json_path',
+                        help='also write the results to this file')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    endpoints = subparsers.add_parser('endpoints')
+    endpoints.add_argument('--replay', help='JSON lines traffic file')
+    endpoints.add_argument('--requests', type=int, default=2000,
+                           help='approximate synthetic request count')
+    endpoints.add_argument('--update-batch', type=int, default=1,
+                           help='jenkins callbacks per /update/batch '
+                                'request, 1 uses /update')
+    endpoints.add_argument('--persistence', default=PERSISTENCE_JOURNAL)
+    endpoints.add_argument('--workers', type=int, default=4)
+    endpoints.add_argument('--jenkins-latency', type=float, default=0.0,
+                           help='seconds the jenkins stand-in waits')
+    endpoints.add_argument('--slack-latency', type=float, default=0.0,
+                           help='seconds the slack stand-in waits')
+    endpoints.set_defaults(func=bench_endpoints)
+
+    store = subparsers.add_parser('store')
+    store.add_argument('--sizes', default=STORE_SIZES)
+    store.add_argument('--persistence-modes', default=PERSISTENCE_MODES)
+    store.add_argument('--read-ops', type=int, default=1000)
+    store.add_argument('--scan-ops', type=int, default=20)
+    store.add_argument('--write-ops', type=int, default=20)
+    store.set_defaults(func=bench_store)
+
+    args = parser.parse_args()
+    results = args.func(args)
+    if args.json_path:
+        with open(args.json_path, 'w') as fp:
+            json.dump(results, fp, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+""" Recovery of cluster status changes from lost jenkins callbacks """
+
+import logging
+import threading
+
+from cluster_record import ClusterStatus
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = 300
+# newest builds of a job fetched per query
+MAX_BUILDS = 200
+# tolerated clock difference between this host and jenkins
+CLOCK_SKEW = 300
+# statuses which still wait for a jenkins build to finish
+PENDING_STATUSES = (ClusterStatus.CREATING, ClusterStatus.RUNNING,
+                    ClusterStatus.DELETE_FAILED)
+BUILD_TREE = ('builds[number,building,result,timestamp,'
+              'actions[parameters[name,value]]]{{0,{}}}')
+# jenkins build result -> cluster status
+CREATE_RESULTS = {'SUCCESS': ClusterStatus.RUNNING,
+                  'FAILURE': ClusterStatus.FAILED,
+                  'ABORTED': ClusterStatus.FAILED}
+DELETE_RESULTS = {'SUCCESS': ClusterStatus.DELETE_SUCCESS,
+                  'FAILURE': ClusterStatus.DELETE_FAILED,
+                  'ABORTED': ClusterStatus.DELETE_FAILED}
+
+
+def job_api_url(build_url):
+    """
+    JSON API url of the job of a buildWithParameters url
+    """
+    return build_url.rsplit('/buildWithParameters', 1)[0] + '/api/json'
+
+
+class BuildReconciler:
+    """
+    Purpose: Recover the status of clusters whose jenkins /update callback
+    got lost. The records still waiting for a build are matched with the
+    builds of the create and delete jobs, fetched with one tree filtered
+    (conditional) JSON API query per job, and the status changes are
+    applied in one persisted batch.
+    """
+
+    def __init__(self, cluster_mgmt, interval=RECONCILE_INTERVAL,
+                 max_builds=MAX_BUILDS, on_change=None):
+        """
+        :param cluster_mgmt: ClusterMgmt with the config and jenkins client
+        :param on_change: called as on_change(user_name, cluster_name,
+                          status) for every applied status change
+        """
+        self._cluster_mgmt = cluster_mgmt
+        self._interval = interval
+        self._max_builds = max_builds
+        self._on_change = on_change
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, daemon=True,
+                                        name='build-reconciler')
+        self._thread.start()
+
+    def _worker(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.error('Exception found: %s', e)
+
+    def _builds_by_cluster(self, build_url):
+        """
+        :return: cluster name -> builds of the job for it, newest first
+        :rtype: dict
+        """
+        data = self._cluster_mgmt.jenkins_client.get_json(
+            job_api_url(build_url),
+            params={'tree': BUILD_TREE.format(self._max_builds)})
+        builds = {}
+        for build in data.get('builds') or []:
+            for action in build.get('actions') or []:
+                for param in (action or {}).get('parameters') or []:
+                    if param.get('name') == 'AWS_CLUSTER_NAME':
+                        builds.setdefault(param.get('value'),
+                                          []).append(build)
+        return builds
+
+    @staticmethod
+    def _finished_build(builds, since):
+        """
+        :return: result of the newest build started after since (epoch
+                 seconds), None if there is none or it is still running
+        """
+        for build in builds:
+            if build.get('timestamp', 0) / 1000.0 < since - CLOCK_SKEW:
+                return None
+            if build.get('building'):
+                return None
+            return build.get('result')
+        return None
+
+    def _new_status(self, cluster, create_builds, delete_builds):
+        since = cluster.creation_time or 0
+        name = cluster.name
+        # a finished deletion overrides whatever the creation reported
+        status = DELETE_RESULTS.get(self._finished_build(
+            delete_builds.get(name, []), since))
+        if status is None and cluster.status is ClusterStatus.CREATING:
+            status = CREATE_RESULTS.get(self._finished_build(
+                create_builds.get(name, []), since))
+        return status
+
+    def reconcile(self):
+        """
+        Apply the results of finished jenkins builds to the records
+        :return: list of (user name, cluster name, new status)
+        :rtype: list
+        """
+        pending = self._cluster_mgmt.get_clusters_by_status(
+            *PENDING_STATUSES)
+        if not pending:
+            return []
+        config_data = self._cluster_mgmt.config_data
+        create_builds = self._builds_by_cluster(
+            config_data['JENKINS_AWS_CREATE'])
+        delete_builds = self._builds_by_cluster(
+            config_data['JENKINS_AWS_DELETE'])
+        changes = []
+        for user_name, cluster in pending:
+            status = self._new_status(cluster, create_builds, delete_builds)
+            if status is not None and status is not cluster.status:
+                changes.append((user_name, cluster.name, status))
+        if not changes:
+            return []
+        with self._cluster_mgmt.batch():
+            for user_name, cluster_name, status in changes:
+                self._cluster_mgmt.update_cluster_attribute(
+                    user_name, {'name': cluster_name, 'status': status})
+        logger.info('reconciled %s clusters from jenkins builds: %s',
+                    len(changes), changes)
+        if self._on_change:
+            for change in changes:
+                self._on_change(*change)
+        return changes
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout)
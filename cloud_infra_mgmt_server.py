@@ -1,51 +1,136 @@
+import logging
 import os
-from pathlib import Path
-from dotenv import load_dotenv
+import threading
 import requests
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify, Response
 from slack_bolt import App, Say
 from slack_bolt.adapter.flask import SlackRequestHandler
 from slack_sdk import WebClient
-from apscheduler.schedulers.background import BackgroundScheduler
 import time
-import json
 from cluster_management import ClusterMgmt, ClusterDbMgmt
+from cluster_record import ClusterStatus, parse_status
+from command_queue import CommandQueue, COMMAND_QUEUE_DEPTH, COMMAND_WORKERS
+from slack_notifier import SlackNotifier, COALESCE_WINDOW, MIN_POST_INTERVAL
+from build_reconciler import BuildReconciler, RECONCILE_INTERVAL
+from idempotency import (IdempotencyCache, DEDUP_TTL, DEDUP_MAX_ENTRIES,
+                         DUPLICATE_WAIT)
+from expiry_scheduler import (ExpiryScheduler, ExpiryLeader, EXPIRY_WARNINGS,
+                              LEADER_LOCK_PATH, SYNC_INTERVAL)
+from service_config import ConfigCache, CONFIG_PATH, ENV_PATH
+import metrics
+from metrics import (SLACK_COMMAND_DURATION, UPDATE_CALLBACK_DURATION,
+                     UPDATE_BATCH_DURATION, UPDATE_BATCH_SIZE)
 
-# Initialize Flask app and Slack app
-app = Flask(__name__)
+logger = logging.getLogger(__name__)
+SLASH_COMMANDS = ("/create_cluster", "/delete_cluster", "/clusters")
+# commands which trigger jenkins builds, retries of them are deduplicated
+DEDUP_COMMANDS = ("/create_cluster", "/delete_cluster")
+# answer of a duplicate whose original request didn't finish yet
+IN_PROGRESS_MESSAGE = "request is in progress"
+QUEUE_FULL_MESSAGE = "too many requests in progress, please retry in a while"
+# most updates accepted by one /update/batch request
+MAX_BATCH_UPDATES = 500
 
-env_path = Path('.') / '.env'
-load_dotenv(dotenv_path=env_path)
-slack_app = App(
-    token=os.environ['BOT_TOKEN'],
-    signing_secret=os.environ['SIGNING_SECRET']
-)
+# Routes of the service, registered on the flask app by create_app
+bp = Blueprint('cloud_infra_mgmt', __name__)
 
-client = WebClient(token=os.environ.get("BOT_TOKEN"))
+# config.json and .env, read on first use and whenever they change
+config = ConfigCache()
+
+
+def cache_result(key, result):
+    # a rejected command or an update of a record which isn't stored yet
+    # (the callback raced the create command) must run again when retried
+    if key[0] == 'update':
+        return result == 'success'
+    return result != QUEUE_FULL_MESSAGE
+
+
+# results of recent commands and callbacks, for retries and duplicates
+dedup = IdempotencyCache(pending_result=IN_PROGRESS_MESSAGE,
+                         should_cache=cache_result)
+
+# slack bolt app and its request handler, created on first use as the bolt
+# app calls auth.test when it gets created
+_slack = {}
+_slack_lock = threading.Lock()
 
 global obj_cluster
+global command_queue
+global notifier
+
+
+def get_config():
+    return config.get()
+
+
+def get_slack_handler():
+    with _slack_lock:
+        if 'handler' not in _slack:
+            # SLACK_TOKEN_VERIFICATION=false skips the auth.test call, e.g.
+            # when running against the local stand-ins of benchmark.py
+            slack_app = App(
+                token=os.environ['BOT_TOKEN'],
+                signing_secret=os.environ['SIGNING_SECRET'],
+                token_verification_enabled=os.environ.get(
+                    'SLACK_TOKEN_VERIFICATION', 'true').lower() != 'false'
+            )
+            slack_app.message("hello")(greetings)
+            _slack['handler'] = SlackRequestHandler(slack_app)
+        return _slack['handler']
 
 
 # Route for handling slash command requests
-@app.route("/slack/command", methods=["POST", "GET"])
+@bp.route("/slack/command", methods=["POST", "GET"])
 def command():
-    message = cmd_text = None
-    load_dotenv(dotenv_path=env_path)
     # Parse request body data
     data = request.form
-    print("serving {} cluster".format(data["command"]))
+    label = data["command"] if data["command"] in SLASH_COMMANDS else "other"
+    with SLACK_COMMAND_DURATION.labels(label).time():
+        return handle_command(data)
+
+
+def handle_command(data):
+    if data["command"] in DEDUP_COMMANDS:
+        if request.headers.get('X-Slack-Retry-Num'):
+            logger.info("slack retry %s of %s",
+                        request.headers.get('X-Slack-Retry-Num'),
+                        data["command"])
+        message = dedup.run(command_key(data), command_message, data)
+    else:
+        message = command_message(data)
+    # Return response to Slack
+    return jsonify({"text": message})
+
+
+def command_key(data):
+    # retries of slack carry the trigger_id of the original request, the
+    # same command text of a user is repeated within the dedup ttl otherwise
+    if data.get('trigger_id'):
+        return 'command', data['trigger_id']
+    return 'command', data.get('user_id'), data["command"], data.get('text')
+
+
+def command_message(data):
+    message = cmd_text = None
+    # reloads config.json/.env when they changed, obj_cluster follows
+    get_config()
+    logger.info("serving %s cluster", data["command"])
     # Call the appropriate function based on the slash command
+    # create and delete trigger jenkins, which can take longer than the
+    # slack deadline, they are acknowledged now and answered through the
+    # response_url
     if data["command"] == "/create_cluster":
         cmd_text = data.get('text')
         if cmd_text:
-            message = obj_cluster.initiate_cluster_creation(data['user_id'],
-                                                            cmd_text)
+            message = submit_command(obj_cluster.initiate_cluster_creation,
+                                     data, cmd_text)
         # message = get_joke()
     elif data["command"] == "/delete_cluster":
         cmd_text = data.get('text')
         if cmd_text:
-            message = obj_cluster.delete_cluster(data['user_id'],
-                                                 cmd_text)
+            message = submit_command(obj_cluster.delete_cluster, data,
+                                     cmd_text)
     elif data["command"] == "/clusters":
         message = obj_cluster.get_clusters_by_user(data['user_id'])
     else:
@@ -53,47 +138,192 @@ def command():
 
     if not message:
         message = "command parameters are not provided"
-    # Return response to Slack
-    return jsonify({"text": str(message)})
+    return str(message)
+
 
+def submit_command(func, data, cmd_text):
+    if command_queue.submit(data.get('response_url'), func,
+                            data['user_id'], cmd_text):
+        return "{} request accepted, result will follow shortly".format(
+            data["command"])
+    return QUEUE_FULL_MESSAGE
 
-@app.route("/update", methods=["PUT", "POST"])
+
+@bp.route("/update", methods=["PUT", "POST"])
 def update_cluster_info():
-    print("in update cluster info: {}".format(request))
-    json_data = request.get_json()
-    user_name = json_data.pop('user_id')
-    obj_cluster.update_cluster_attribute(user_name, json_data)
-    msg = None
-    if json_data.get('status') == 'running':
+    with UPDATE_CALLBACK_DURATION.time():
+        json_data = request.get_json()
+        changes = []
+        key = update_key(json_data)
+        if key is None:
+            apply_update(json_data, changes)
+        else:
+            dedup.run(key, apply_update, json_data, changes)
+        notify_statuses(changes)
+        return "success", 201
+
+
+@bp.route("/update/batch", methods=["PUT", "POST"])
+def update_cluster_info_batch():
+    """
+    Apply a list of /update payloads, given as JSON list or as the updates
+    list of a JSON object, with one persistence flush and one slack message
+    :return: per update user_id, name and result, 201 if all succeeded and
+             207 otherwise
+    """
+    with UPDATE_BATCH_DURATION.time():
+        json_data = request.get_json(silent=True)
+        updates = json_data.get('updates') if isinstance(json_data, dict) \
+            else json_data
+        if not isinstance(updates, list):
+            return jsonify({"error": "expected a list of updates"}), 400
+        if len(updates) > MAX_BATCH_UPDATES:
+            return jsonify({"error": "at most {} updates per request".format(
+                MAX_BATCH_UPDATES)}), 413
+        UPDATE_BATCH_SIZE.observe(len(updates))
+        results = [batch_result(json_data) for json_data in updates]
+        # duplicates are answered before the store gets locked, without
+        # waiting for a running original
+        claimed = {}
+        pending = []
+        repeated = []
+        for json_data, result in zip(updates, results):
+            if 'result' in result:
+                continue
+            key = update_key(json_data)
+            ticket = None
+            if key is not None:
+                if key in claimed:
+                    repeated.append((key, result))
+                    continue
+                ticket, result['result'] = dedup.claim(key)
+                if ticket is None:
+                    continue
+                claimed[key] = result
+            pending.append((key, json_data, result, ticket))
+        changes = []
+        try:
+            with obj_cluster.batch():
+                while pending:
+                    key, json_data, result, ticket = pending.pop(0)
+                    result['result'] = batch_update(key, json_data, ticket,
+                                                    changes)
+        finally:
+            for key, _, result, ticket in pending:
+                if ticket is not None:
+                    dedup.complete(key, ticket, failed=True)
+                result['result'] = 'failed'
+        for key, result in repeated:
+            result['result'] = claimed[key]['result']
+        notify_statuses(changes)
+        failed = any(result['result'] != 'success' for result in results)
+        return jsonify({"results": results}), 207 if failed else 201
+
+
+def batch_result(json_data):
+    if not isinstance(json_data, dict) or not json_data.get('name'):
+        return {"user_id": None, "name": None,
+                "result": "invalid update, name is missing"}
+    return {"user_id": json_data.get('user_id'),
+            "name": json_data.get('name')}
+
+
+def batch_update(key, json_data, ticket, changes):
+    """
+    Apply an update of a batch, claimed from the idempotency cache unless
+    ticket is None
+    :return: result of the update
+    """
+    try:
+        ret = apply_update(json_data, changes)
+    except Exception as e:
+        logger.error('Exception found: %s', e)
+        if ticket is not None:
+            dedup.complete(key, ticket, failed=True)
+        return 'failed'
+    if ticket is not None:
+        dedup.complete(key, ticket, ret)
+    return ret
+
+
+def update_key(json_data):
+    """
+    :return: idempotency key of an /update payload, None if it has no
+             build_id: a repeated callback reports the same status of the
+             same build, without the build two builds of a cluster (e.g. a
+             retried delete failing again) can't be told apart
+    """
+    if json_data.get('build_id') is None:
+        return None
+    return ('update', json_data['build_id'], json_data.get('user_id'),
+            json_data.get('name'), json_data.get('status'))
+
+
+def apply_update(json_data, changes):
+    """
+    Apply the attributes of an /update payload to the cluster record
+    :param changes: (user, cluster name, status) of an applied update is
+                    appended for the notification
+    :return: result of update_cluster_attribute
+    """
+    logger.info("in update cluster info: %s", json_data)
+    json_data = dict(json_data)
+    user_name = json_data.pop('user_id', None)
+    ret = obj_cluster.update_cluster_attribute(user_name, json_data)
+    if ret == 'success':
+        changes.append((user_name, json_data.get('name'),
+                        json_data.get('status')))
+    return ret
+
+
+def notify_status(user_name, cluster_name, status):
+    notify_statuses([(user_name, cluster_name, status)])
+
+
+def notify_statuses(changes):
+    """
+    Post the status changes as one slack message
+    :param changes: list of (user name, cluster name, status)
+    """
+    if changes:
+        notifier.notify(get_config().get('SLACK_CHANNEL'), '\n'.join(
+            status_message(cluster_name, status)
+            for _, cluster_name, status in changes))
+
+
+def status_message(cluster_name, status):
+    status = parse_status(status)
+    if status is ClusterStatus.RUNNING:
         msg = 'cluster:{} got created successfully and in running state.' \
               ' Run command: /clusters to know details to login'. \
-            format(json_data.get('name'))
-    elif json_data.get('status') == 'delete_success':
-        msg = "Cluster {} deleted successfully".format(json_data.get('name'))
-    elif json_data.get('status') == 'delete_failed':
-        msg = "Cluster {} failed to delete".format(json_data.get('name'))
+            format(cluster_name)
+    elif status is ClusterStatus.DELETE_SUCCESS:
+        msg = "Cluster {} deleted successfully".format(cluster_name)
+    elif status is ClusterStatus.DELETE_FAILED:
+        msg = "Cluster {} failed to delete".format(cluster_name)
     else:
-        msg = 'cluster: {} creation failed'
-    client.chat_postMessage(channel=config_json.get('SLACK_CHANNEL'),
-                            text=msg)
+        msg = 'cluster: {} creation failed'.format(cluster_name)
+    return msg
+
 
-    return "success", 201
+@bp.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
 
 
-@app.route("/slacky/events", methods=["POST"])
+@bp.route("/slacky/events", methods=["POST"])
 def slack_events():
     """ Declaring the route where slack will post a request """
-    return handler.handle(request)
+    return get_slack_handler().handle(request)
 
 
-@slack_app.message("hello")
 def greetings(payload: dict, say: Say):
     """ This will check all the message and pass only those which has 'hello slacky' in it """
     user = payload.get("user")
     say(f"Hi <@{user}>")
 
 
-@app.route("/")
+@bp.route("/")
 def hello_world():
     return "<p>Hello, World!</p>"
 
@@ -107,35 +337,101 @@ def get_joke():
     return joke
 
 
-# Initialize SlackRequestHandler to handle requests from Slack
-handler = SlackRequestHandler(slack_app)
-
-
 def print_date_time():
-    print(time.strftime("%A, %d. %B %Y %I:%M:%S %p"))
+    logger.info(time.strftime("%A, %d. %B %Y %I:%M:%S %p"))
 
 
-def alert_expiring_clusters():
-    exp_duration = config_json['CLUSTER_EXPIRATION_DURATION']*24
-    msg = 'Following clusters will be expiring soon: {}'.format(obj_cluster.get_expiring_clusters(exp_duration))
-    client.chat_postMessage(channel=config_json.get('SLACK_CHANNEL'),
-                            text=msg)
+def alert_expiring_cluster(user_name, cluster_name, hours, expiration):
+    # the time left is told from the expiration rather than the threshold,
+    # the warning may come late e.g. after a wall clock jump
+    left = expiration - time.time()
+    minutes = int(round(left / 60))
+    if minutes >= 60:
+        msg = 'cluster: {} of <@{}> will expire in {} hrs'.format(
+            cluster_name, user_name, int(round(minutes / 60.0)))
+    elif left > 0:
+        msg = 'cluster: {} of <@{}> will expire in {} min'.format(
+            cluster_name, user_name, max(1, minutes))
+    else:
+        msg = 'cluster: {} of <@{}> expired'.format(cluster_name, user_name)
+    notifier.notify(get_config().get('SLACK_CHANNEL'), msg)
 
 
-if __name__ == "__main__":
-    global obj_cluster
-    config_json = None
-    with open('config.json') as fp:
-        config_json = json.load(fp)
+def create_app(config_path=CONFIG_PATH, env_path=ENV_PATH,
+               multi_worker=False, slack_client=None):
+    """
+    Application factory: load and validate the config, start the background
+    services of this process and return the flask app. No network calls are
+    made, the slack bolt app gets created by the first slack event.
+    :param multi_worker: the process is one of several WSGI workers, they
+                         share the db and only one of them runs the expiry
+                         scheduler
+    :param slack_client: client posting the notifications, a WebClient of
+                         BOT_TOKEN by default
+    """
+    global obj_cluster, command_queue, notifier, config, dedup
+    config = ConfigCache(config_path, env_path)
+    config_json = config.get()
+    dedup = IdempotencyCache(
+        ttl=config_json.get('DEDUP_TTL', DEDUP_TTL),
+        max_entries=config_json.get('DEDUP_MAX_ENTRIES', DEDUP_MAX_ENTRIES),
+        duplicate_wait=DUPLICATE_WAIT,
+        pending_result=IN_PROGRESS_MESSAGE,
+        should_cache=cache_result)
+    logging.basicConfig(
+        level=config_json.get('LOG_LEVEL', 'INFO'),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
 
-    obj_cluster = ClusterMgmt()
+    obj_cluster = ClusterMgmt(
+        db_path=config_json.get('DB_PATH'),
+        persistence=config_json.get('DB_PERSISTENCE', 'json'),
+        shared=multi_worker)
     obj_cluster.set_config_data(config_json)
+    config.on_change(obj_cluster.set_config_data)
+    command_queue = CommandQueue(
+        max_depth=config_json.get('COMMAND_QUEUE_DEPTH', COMMAND_QUEUE_DEPTH),
+        workers=config_json.get('COMMAND_WORKERS', COMMAND_WORKERS))
+    command_queue.start()
+    notifier = SlackNotifier(
+        slack_client or WebClient(token=os.environ.get("BOT_TOKEN")),
+        coalesce_window=config_json.get('SLACK_COALESCE_WINDOW',
+                                        COALESCE_WINDOW),
+        min_interval=config_json.get('SLACK_MIN_POST_INTERVAL',
+                                     MIN_POST_INTERVAL))
+    notifier.start()
     # obj_cluster.initiate_cluster_creation('manish singh',
     #                                       'name:cluster_name, version:4.9, type:AWS_ROSA, ')
     # data = obj_cluster.get_clusters_by_user('manish singh')
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(func=alert_expiring_clusters, trigger="interval",
-                      seconds=config_json['CLUSTER_POLL_INTERVAL'])
-    scheduler.start()
+    expiry_scheduler = ExpiryScheduler(
+        alert_expiring_cluster,
+        warnings=config_json.get('CLUSTER_EXPIRY_WARNINGS', EXPIRY_WARNINGS))
+    # polls jenkins for builds whose /update callback got lost, 0 disables
+    reconciler = None
+    if config_json.get('RECONCILE_INTERVAL', RECONCILE_INTERVAL):
+        reconciler = BuildReconciler(
+            obj_cluster,
+            interval=config_json.get('RECONCILE_INTERVAL',
+                                     RECONCILE_INTERVAL),
+            on_change=notify_status)
+    # the expiry scheduler and the reconciler run in one process only
+    if multi_worker:
+        ExpiryLeader(
+            obj_cluster, expiry_scheduler,
+            lock_path=config_json.get('EXPIRY_LEADER_LOCK', LEADER_LOCK_PATH),
+            sync_interval=config_json.get('EXPIRY_SYNC_INTERVAL',
+                                          SYNC_INTERVAL),
+            on_elected=reconciler.start if reconciler else None).start()
+    else:
+        obj_cluster.set_expiry_scheduler(expiry_scheduler)
+        expiry_scheduler.start()
+        if reconciler:
+            reconciler.start()
+
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    return app
+
+
+if __name__ == "__main__":
     # Start the Flask app on port 5000
-    app.run(port=5000, debug=True)
+    create_app().run(port=5000, debug=True)
@@ -1,45 +1,153 @@
-import json
-import os
+import fnmatch
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
 
+import requests
+
+from cluster_record import ClusterStatus, TIME_FORMAT
+from cluster_store import PERSISTENCE_JSON, create_store
+from jenkins_client import JenkinsClient
+from metrics import EXPIRY_SCAN_DURATION
+
+logger = logging.getLogger(__name__)
+
+# clusters in these states are gone, they don't expire anymore
+TERMINAL_STATUSES = (ClusterStatus.DELETE_SUCCESS, ClusterStatus.FAILED)
+# jenkins builds triggered at once by a single command
+BUILD_CONCURRENCY = 4
+# clusters a single create or delete command may cover
+MAX_CLUSTERS_PER_COMMAND = 50
+# specs of /create_cluster are separated by ';' or new lines, the names of
+# /delete_cluster by white space, ',' or ';'
+SPEC_SEPARATORS = re.compile(r'[;\n]')
+NAME_SEPARATORS = re.compile(r'[\s,;]+')
+GLOB_CHARS = '*?['
+
+
+def parse_cluster_specs(cmd_text):
+    """
+    Parse the "name:..., type:..." specs of a create command
+    :return: list of dicts of the spec parameters
+    :rtype: list
+    """
+    specs = []
+    for spec in SPEC_SEPARATORS.split(cmd_text):
+        cluster_dict = {}
+        for param in spec.split(','):
+            param = param.strip()
+            if not param:
+                continue
+            cmd_value = param.split(':')
+            if len(cmd_value) < 2:
+                raise ValueError("invalid parameter {}, expected "
+                                 "key:value".format(param))
+            cluster_dict[cmd_value[0].strip()] = cmd_value[1].strip()
+        if cluster_dict:
+            specs.append(cluster_dict)
+    return specs
+
 
 class ClusterDbMgmt:
-    def __init__(self, db_path='cluster_info.json'):
-        print("in Cluster db management")
-        self.__db_path = db_path
-        self._db_data = self.get_db_data()
-        if not self._db_data:
-            self._db_data = {}
+    def __init__(self, db_path=None, persistence=PERSISTENCE_JSON,
+                 store=None, **store_kwargs):
+        """
+        :param db_path: path of the db, defaults as per the persistence mode
+        :param persistence: json, journal or sqlite, see cluster_store
+        :param store: ClusterStore instance to use instead of creating one
+                      for the persistence mode
+        """
+        logger.debug("in Cluster db management")
+        self._store = store or create_store(persistence, db_path,
+                                            **store_kwargs)
+        self.expiry_scheduler = None
+        self._synced_snapshot = None
+
+    def set_expiry_scheduler(self, expiry_scheduler):
+        """
+        Keep the expiration warnings of expiry_scheduler in sync with the
+        records, the existing records are armed right away. Their warnings
+        whose time passed already, e.g. while the service was down, aren't
+        announced.
+        """
+        self.expiry_scheduler = expiry_scheduler
+        self._synced_snapshot = None
+        self.sync_expiry_scheduler()
+
+    def sync_expiry_scheduler(self):
+        """
+        Arm the expiry scheduler from all the records, e.g. after other
+        processes changed them. Nothing is done while the snapshot of the
+        records stays the same.
+        :return: True when the scheduler got synced
+        """
+        snapshot = self.snapshot()
+        if self.expiry_scheduler is None or \
+                snapshot is self._synced_snapshot:
+            return False
+        self._synced_snapshot = snapshot
+        keys = set()
+        for user_name, clusters in snapshot.items():
+            for cluster in clusters:
+                keys.add((user_name, cluster.name))
+                self._arm_expiry(user_name, cluster)
+        self.expiry_scheduler.retain(keys)
+        return True
+
+    def _arm_expiry(self, user_name, cluster):
+        if self.expiry_scheduler is None or cluster is None:
+            return
+        if cluster.status in TERMINAL_STATUSES:
+            self.expiry_scheduler.cancel(user_name, cluster.name)
+            return
+        if cluster.expiration_time is None:
+            return
+        self.expiry_scheduler.arm(user_name, cluster.name,
+                                  cluster.expiration_time)
 
     def get_db_data(self):
-        try:
-            with open(self.__db_path) as fp:
-                self._db_data = json.load(fp)
-                return self._db_data
-        except (FileNotFoundError, Exception) as e:
-            print('Exception found: {}'.format(str(e)))
+        return self._store.reload()
+
+    def get_cluster(self, user_name, cluster_name):
+        """
+        Lookup a cluster record of the user
+        :return: cluster record or None
+        :rtype: ClusterRecord
+        """
+        return self._store.get_cluster(user_name, cluster_name)
+
+    def find_cluster(self, cluster_name):
+        """
+        Lookup a cluster record by its name only
+        :return: tuple of user name and cluster record, (None, None) if
+                 the cluster doesn't exist
+        :rtype: tuple
+        """
+        return self._store.find_cluster(cluster_name)
 
     def is_cluster_exist(self, user_name, cluster_info):
-        if user_name not in self._db_data:
-            return False
-        for cluster in self._db_data[user_name]:
-            if cluster.get('name') == cluster_info.get('name'):
-                return True
-        return False
+        return self.get_cluster(user_name,
+                                cluster_info.get('name')) is not None
 
     def update_cluster_attribute(self, user_name, attribute_info):
-        print("in update cluster attribute")
-        cluster_exist = False
-        if not (self._db_data and user_name in self._db_data.keys()):
-            return "username doesn't exist"
-        for cluster in self._db_data[user_name]:
-            if cluster.get('name') == attribute_info.get('name'):
-                cluster_exist = True
-                cluster.update(attribute_info)
-        if not cluster_exist:
-            return "cluster doesn't exist"
-        self.update_db()
-        return "success"
+        """
+        Update the attributes of an existing cluster record.
+        :param user_name: owner of the cluster, if None the owner is
+                          resolved through the cluster name
+        :param attribute_info: dictionary of attributes with cluster name
+        """
+        logger.debug("in update cluster attribute")
+        ret = self._store.update_cluster_attribute(user_name, attribute_info)
+        if ret == 'success' and self.expiry_scheduler is not None:
+            if user_name is None:
+                user_name, cluster = self.find_cluster(
+                    attribute_info.get('name'))
+            else:
+                cluster = self.get_cluster(user_name,
+                                           attribute_info.get('name'))
+            self._arm_expiry(user_name, cluster)
+        return ret
 
     def get_expiring_clusters(self, exp_interval):
         """
@@ -51,63 +159,73 @@ class ClusterDbMgmt:
         :return: dictionary of cluster name and remaining hours
         :rtype: dict
         """
-        print('in get expiring cluster')
-        cluster_time_dic = {}
-        for user, clusters in self._db_data.items():
-            for cluster in clusters:
-                exp_time = datetime.strptime(cluster['expiration_time'], '%Y-%m-%d %H:%M:%S')
-                diff = int((exp_time - datetime.now()).total_seconds()/3600)
-                if diff <= exp_interval:
-                    cluster_time_dic[cluster.get('name')] = str(diff)+" hrs"
-        return cluster_time_dic
+        logger.debug('in get expiring cluster')
+        with EXPIRY_SCAN_DURATION.time():
+            return self._store.get_expiring_clusters(exp_interval)
+
+    def get_expired_clusters(self):
+        """
+        :return: dictionary of already expired cluster names and the hours
+                 since their expiration (negative)
+        :rtype: dict
+        """
+        return self._store.get_expired_clusters()
+
+    def get_expiring_clusters_by_user(self, user_name, exp_interval):
+        """
+        Same as get_expiring_clusters but limited to the clusters of a user
+        :rtype: dict
+        """
+        return self._store.get_expiring_clusters_by_user(user_name,
+                                                         exp_interval)
 
     def update_cluster_info(self, user_name, cluster_info):
         try:
-            updated_data = {}
-            self.get_db_data()
-            if self._db_data and user_name in self._db_data.keys():
-                if self.is_cluster_exist(user_name, cluster_info):
-                    return 'cluster already exist'
-                self._db_data[user_name].append(cluster_info)
-            else:
-                self._db_data[user_name] = [cluster_info]
-            if self._db_data:
-                print("updated data: {}".format(self._db_data))
-            self.update_db()
-            return 'success'
+            ret = self._store.update_cluster_info(user_name, cluster_info)
         except (FileNotFoundError, Exception) as e:
-            print('Exception found: {}'.format(str(e)))
+            logger.error('Exception found: %s', e)
             return 'failed'
+        if ret == 'success' and self.expiry_scheduler is not None:
+            self._arm_expiry(user_name, self.get_cluster(
+                user_name, cluster_info.get('name')))
+        return ret
 
     def delete_record(self, user_id, cluster_name):
-        index = 0
-        is_present = False
-        for item in self._db_data.get(user_id):
-            if item.get('name') == cluster_name:
-                is_present = True
-                break
-            index += 1
-        if is_present:
-            self._db_data.get(user_id).pop(index)
-            self.update_db()
-            return "cluster deletion initiated"
-        else:
-            return "cluster name/user id not found"
-
-    def update_db(self):
-        try:
-            with open(self.__db_path, 'w') as fp:
-                json.dump(self._db_data, fp, indent=4)
-        except (FileNotFoundError, Exception) as e:
-            print('Exception found: {}'.format(str(e)))
-            return 'failed'
+        ret = self._store.delete_record(user_id, cluster_name)
+        if self.expiry_scheduler is not None:
+            self.expiry_scheduler.cancel(user_id, cluster_name)
+        return ret
 
     def get_clusters_by_user(self, user_name, refresh_data=False):
 
         if refresh_data:
-            self.get_db_data()
+            self._store.refresh()
+
+        return self._store.get_clusters_by_user(user_name)
+
+    def get_clusters_by_status(self, *statuses):
+        """
+        :return: list of (user name, cluster record) in any of the statuses
+        :rtype: list
+        """
+        return self._store.get_clusters_by_status(*statuses)
+
+    def batch(self):
+        """
+        Context manager persisting all the changes made in it at once
+        """
+        return self._store.batch()
+
+    def snapshot(self):
+        """
+        Consistent read-only view of all the records, cheap to take
+        repeatedly from any thread
+        :return: mapping of user -> tuple of cluster records
+        """
+        return self._store.snapshot()
 
-        return self._db_data[user_name]
+    def close(self):
+        self._store.close()
 
     def delete_cluster(self, user_name, cluster_info):
         return "in delete cluster for user {} and clsuter".format(user_name,
@@ -115,96 +233,215 @@ class ClusterDbMgmt:
 
 
 class ClusterMgmt(ClusterDbMgmt):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, jenkins_client=None, **kwargs):
+        super().__init__(**kwargs)
         self.config_data = None
-        print("in Cluster management class")
+        self.jenkins_client = jenkins_client
+        logger.debug("in Cluster management class")
 
     def set_config_data(self, config_data):
         self.config_data = config_data
+        if self.jenkins_client is None:
+            self.jenkins_client = JenkinsClient.from_config(config_data)
 
     def initiate_cluster_creation(self, user_name, cmd_text):
-        print("Initiating cluster creation using Jenkin's Job")
+        """
+        Trigger the creation of one or several clusters. All the specs are
+        validated before any build gets triggered, the builds run
+        concurrently and the records are persisted in one write.
+        :param cmd_text: specs "name:..., type:..., region:..." separated by
+                         ';' or new lines
+        :return: result message, one line per cluster for several specs
+        """
+        logger.info("Initiating cluster creation using Jenkin's Job")
         try:
-            cmd_text = cmd_text.split(',')
-            error_msg = ''
-            cluster_dict = {}
-            for param in cmd_text:
-                param = param.strip()
-                if not param:
-                    continue
-                cmd_value = param.split(':')
-                key = cmd_value[0].strip()
-                value = cmd_value[1].strip()
-                cluster_dict[key] = value
-
-                if key == 'type' and value not in self.config_data[
-                    'CLOUD_TYPE']:
-                    error_msg += "wrong cloud type {}. Provide any value among {} \n".format(
-                        value, self.config_data['CLOUD_TYPE'])
-                    return error_msg
-
-            if self.is_cluster_exist(user_name, cluster_dict):
-                return 'cluster already exist, plz try with another name'
-
-            data = {"AWS_CLUSTER_NAME": cluster_dict['name'],
-                    "CLUSTER_OWNER": user_name}
-            if cluster_dict.get('type'):
-                data['AWS_TYPE'] = cluster_dict.get('type')
-            if cluster_dict.get('region'):
-                data['AWS_REGION'] = cluster_dict.get('region')
-            if cluster_dict.get('version'):
-                data['OCP_VERSION'] = cluster_dict.get('version')
-            if cluster_dict.get('node_type'):
-                data['COMPUTE_NODE_TYPE'] = cluster_dict.get('node_type')
-            if cluster_dict.get('node_num'):
-                data['COMPUTE_NODE_NUMBER'] = cluster_dict.get('node_num')
+            specs = parse_cluster_specs(cmd_text)
+            if not specs:
+                return "command parameters are not provided"
+            if len(specs) > MAX_CLUSTERS_PER_COMMAND:
+                return "at most {} clusters per command".format(
+                    MAX_CLUSTERS_PER_COMMAND)
+            errors = self.validate_cluster_specs(user_name, specs)
+            if errors and len(specs) == 1:
+                return errors[0]
+            if errors:
+                return "no cluster creation initiated, invalid specs:\n" + \
+                    self._join_results(specs, errors)
+            results = self._run_builds(
+                lambda cluster_dict: self._trigger_creation(user_name,
+                                                            cluster_dict),
+                specs)
+            messages = []
+            with self.batch():
+                for cluster_dict, (message, record) in zip(specs, results):
+                    if record is not None:
+                        ret = self.update_cluster_info(user_name, record)
+                        logger.debug('cluster record stored: %s', ret)
+                        message = "cluster creation initiated" \
+                            if ret == 'success' else ret
+                    messages.append(message)
+            return self._join_results(specs, messages)
+        except Exception as e:
+            logger.error('Exception found: %s', e)
+            return "exception occurred"
 
+    def validate_cluster_specs(self, user_name, specs):
+        """
+        Check the specs against CLOUD_TYPE, CLOUD_REGION and the existing
+        clusters of the user
+        :return: error message per spec (None if valid), an empty list if
+                 all of them are valid
+        :rtype: list
+        """
+        errors = []
+        names = set()
+        for cluster_dict in specs:
+            name = cluster_dict.get('name')
+            if not name:
+                error = "cluster name is missing"
+            elif cluster_dict.get('type') and cluster_dict['type'] not in \
+                    self.config_data['CLOUD_TYPE']:
+                error = "wrong cloud type {}. Provide any value among {} " \
+                        "\n".format(cluster_dict['type'],
+                                    self.config_data['CLOUD_TYPE'])
+            elif cluster_dict.get('region') and cluster_dict['region'] not \
+                    in self.config_data.get('CLOUD_REGION', []):
+                error = "wrong cloud region {}. Provide any value among {} " \
+                        "\n".format(cluster_dict['region'],
+                                    self.config_data.get('CLOUD_REGION'))
+            elif name in names:
+                error = "cluster name is given more than once"
+            elif self.is_cluster_exist(user_name, cluster_dict):
+                error = 'cluster already exist, plz try with another name'
+            else:
+                error = None
+            names.add(name)
+            errors.append(error)
+        return errors if any(errors) else []
+
+    def _trigger_creation(self, user_name, cluster_dict):
+        """
+        :return: tuple of the error message and None if the build didn't
+                 start, otherwise None and the new cluster record
+        """
+        data = {"AWS_CLUSTER_NAME": cluster_dict['name'],
+                "CLUSTER_OWNER": user_name}
+        if cluster_dict.get('type'):
+            data['AWS_TYPE'] = cluster_dict.get('type')
+        if cluster_dict.get('region'):
+            data['AWS_REGION'] = cluster_dict.get('region')
+        if cluster_dict.get('version'):
+            data['OCP_VERSION'] = cluster_dict.get('version')
+        if cluster_dict.get('node_type'):
+            data['COMPUTE_NODE_TYPE'] = cluster_dict.get('node_type')
+        if cluster_dict.get('node_num'):
+            data['COMPUTE_NODE_NUMBER'] = cluster_dict.get('node_num')
+
+        try:
             ret = self.initiate_jenkins_build(
                 url=self.config_data['JENKINS_AWS_CREATE'], data=data)
-            print(ret)
-            if ret.status_code != 201:
-                return "Jenkins pipeline build failed to initiate and returned: {}".format(
-                    ret.status_code)
-
-            cluster_dict['status'] = "creating"
-            current_datetime = datetime.now()
-            cluster_dict['creation_time'] = current_datetime.strftime(
-                "%Y-%m-%d %H:%M:%S")
-            duration = self.config_data.get('CLUSTER_EXPIRATION_DURATION')*24
-            expiration = current_datetime + timedelta(
-                hours=duration)
-            cluster_dict['expiration_time'] = expiration.strftime(
-                "%Y-%m-%d %H:%M:%S")
-            if error_msg != "":
-                return error_msg
-            ret = self.update_cluster_info(user_name, cluster_dict)
-            if ret != 'success':
-                return ret
-            # return "cluster creation initiated"
-
-            print(ret)
-            return "cluster creation initiated"
-        except Exception as e:
-            print('Exception found: {}'.format(str(e)))
-            return "exception occurred"
+        except requests.RequestException as e:
+            logger.error('Exception found: %s', e)
+            return "Jenkins pipeline build failed to initiate: {}".format(
+                str(e)), None
+        logger.debug('jenkins returned %s', ret.status_code)
+        if ret.status_code != 201:
+            return "Jenkins pipeline build failed to initiate and returned: {}".format(
+                ret.status_code), None
+
+        cluster_dict = dict(cluster_dict)
+        cluster_dict['status'] = ClusterStatus.CREATING
+        current_datetime = datetime.now()
+        cluster_dict['creation_time'] = current_datetime.strftime(
+            TIME_FORMAT)
+        duration = self.config_data.get('CLUSTER_EXPIRATION_DURATION')*24
+        expiration = current_datetime + timedelta(
+            hours=duration)
+        cluster_dict['expiration_time'] = expiration.strftime(
+            TIME_FORMAT)
+        return None, cluster_dict
 
     def delete_cluster(self, user_id, cmd_text):
-        print("In delete cluster")
-        cluster_name = cmd_text.strip()
+        """
+        Trigger the deletion of one or several clusters concurrently
+        :param cmd_text: cluster names separated by white space, ',' or
+                         ';', a name glob (e.g. test-*) matches the clusters
+                         of the user
+        :return: result message, one line per cluster for several clusters
+        """
+        logger.info("In delete cluster")
+        names = self.resolve_cluster_names(user_id, cmd_text)
+        if not names:
+            return "no cluster of yours matches {}".format(cmd_text.strip())
+        if len(names) > MAX_CLUSTERS_PER_COMMAND:
+            return "at most {} clusters per command".format(
+                MAX_CLUSTERS_PER_COMMAND)
+        results = self._run_builds(self._trigger_deletion, names)
+        if len(names) == 1:
+            return results[0]
+        return '\n'.join('{}: {}'.format(name, message)
+                         for name, message in zip(names, results))
+
+    def resolve_cluster_names(self, user_id, cmd_text):
+        """
+        :return: cluster names of a delete command in the given order, the
+                 globs expanded to the matching clusters of the user
+        :rtype: list
+        """
+        names = []
+        for pattern in NAME_SEPARATORS.split(cmd_text.strip()):
+            if not pattern:
+                continue
+            if not any(char in pattern for char in GLOB_CHARS):
+                names.append(pattern)
+                continue
+            try:
+                clusters = self.get_clusters_by_user(user_id)
+            except KeyError:
+                clusters = []
+            names.extend(cluster.name for cluster in clusters
+                         if cluster.status is not ClusterStatus.DELETE_SUCCESS
+                         and fnmatch.fnmatchcase(cluster.name, pattern))
+        # a cluster matched by several names is deleted once
+        return list(dict.fromkeys(names))
+
+    def _trigger_deletion(self, cluster_name):
         url = self.config_data['JENKINS_AWS_DELETE']
-        ret = self.initiate_jenkins_build(url, {'AWS_CLUSTER_NAME': cluster_name})
+        try:
+            ret = self.initiate_jenkins_build(
+                url, {'AWS_CLUSTER_NAME': cluster_name})
+        except requests.RequestException as e:
+            logger.error('Exception found: %s', e)
+            return "Jenkins pipeline build failed to initiate: {}".format(
+                str(e))
         if ret.status_code != 201:
             return "Jenkins pipeline build failed to initiate and returned: {}".format(
                 ret.status_code)
         return "cluster deletion initiated"
 
-    def initiate_jenkins_build(self, url, data):
-        import requests
-        print('rest call of url {} with data {}'.format(url, data))
-        ret = requests.post(
-            url=url,
-            auth=(os.environ['JENKINS_USER'], os.environ['JENKINS_PWD']),
-            data=data)
+    def _run_builds(self, trigger, items):
+        """
+        Call trigger for every item, at most JENKINS_BUILD_CONCURRENCY at
+        once
+        :return: results of trigger in the order of items
+        :rtype: list
+        """
+        workers = min(len(items), self.config_data.get(
+            'JENKINS_BUILD_CONCURRENCY', BUILD_CONCURRENCY))
+        if workers <= 1:
+            return [trigger(item) for item in items]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(trigger, items))
 
-        return ret
+    @staticmethod
+    def _join_results(specs, messages):
+        if len(specs) == 1:
+            return messages[0]
+        return '\n'.join('{}: {}'.format(cluster_dict.get('name'),
+                                         message.strip())
+                         for cluster_dict, message in zip(specs, messages)
+                         if message)
+
+    def initiate_jenkins_build(self, url, data):
+        logger.debug('rest call of url %s with data %s', url, data)
+        return self.jenkins_client.post(url, data=data)
@@ -0,0 +1,290 @@
+""" Compact typed representation of a cluster record """
+
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from enum import Enum
+from functools import lru_cache
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# record keys holding TIME_FORMAT strings in the JSON layout
+TIME_KEYS = ('creation_time', 'expiration_time')
+# record keys with few distinct values, their strings are shared
+INTERNED_KEYS = ('type', 'region', 'version')
+# records of a db are created within a limited time span, the conversion of
+# their timestamps is cached per (local) hour
+TIME_CACHE_SIZE = 4096
+
+
+class ClusterStatus(str, Enum):
+    """
+    Purpose: Status of a cluster as reported by the jenkins jobs. Members
+    compare equal to their string value, so records and callers using the
+    plain strings keep working.
+    """
+    CREATING = 'creating'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    DELETE_SUCCESS = 'delete_success'
+    DELETE_FAILED = 'delete_failed'
+
+    def __str__(self):
+        return self.value
+
+
+_STATUSES = {status.value: status for status in ClusterStatus}
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def parse_status(value):
+    """
+    :return: ClusterStatus of value, an unknown status string is kept as
+             (interned) string, None stays None
+    """
+    if value is None or isinstance(value, ClusterStatus):
+        return value
+    return _STATUSES.get(value) or sys.intern(str(value))
+
+
+@lru_cache(maxsize=TIME_CACHE_SIZE)
+def _hour_epoch(hour_str):
+    # "%Y-%m-%d %H" -> epoch seconds of the start of the local hour, None
+    # if the utc offset changes within or at the end of it
+    start = datetime(int(hour_str[0:4]), int(hour_str[5:7]),
+                     int(hour_str[8:10]), int(hour_str[11:13]))
+    epoch = start.timestamp()
+    if (start + timedelta(hours=1)).timestamp() - epoch != 3600:
+        return None
+    return epoch
+
+
+def parse_time(time_str):
+    """
+    Convert a TIME_FORMAT string of the db into epoch seconds
+    """
+    # slicing the fixed width format is several times faster than strptime
+    if len(time_str) == 19 and time_str[4] == '-' and time_str[10] == ' ' \
+            and time_str[13] == ':' and time_str[16] == ':':
+        try:
+            minute, second = int(time_str[14:16]), int(time_str[17:19])
+            epoch = _hour_epoch(time_str[:13])
+            if epoch is not None and minute < 60 and second < 60:
+                return epoch + minute * 60 + second
+        except ValueError:
+            pass
+    return datetime.strptime(time_str, TIME_FORMAT).timestamp()
+
+
+def to_epoch(value):
+    """
+    :return: epoch seconds of a TIME_FORMAT string or number, None if value
+             is neither
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return parse_time(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=TIME_CACHE_SIZE)
+def _quarter_prefix(quarter):
+    # utc offsets are multiples of 15 minutes, so a quarter hour of epoch
+    # seconds is a quarter hour of local time too
+    local = time.localtime(quarter * 900)
+    return '%04d-%02d-%02d %02d:' % local[:4], local[4]
+
+
+def format_time(epoch):
+    """
+    Convert epoch seconds into a TIME_FORMAT string of the db
+    """
+    seconds = int(epoch)
+    quarter, offset = divmod(seconds, 900)
+    prefix, minute = _quarter_prefix(quarter)
+    return '%s%02d:%02d' % (prefix, minute + offset // 60, offset % 60)
+
+
+def encode_db(db_data):
+    """
+    Serialize user -> list of cluster records (ClusterRecord or dict) into
+    the layout of cluster_info.json with one record per line. json.dumps
+    with indent runs the pure python encoder, the records are encoded one
+    by one with the C encoder instead.
+    :rtype: str
+    """
+    users = []
+    for user_name, clusters in db_data.items():
+        records = ',\n        '.join(
+            json.dumps(cluster.to_dict() if isinstance(cluster, ClusterRecord)
+                       else cluster) for cluster in clusters)
+        if records:
+            records = '\n        {}\n    '.format(records)
+        users.append('    {}: [{}]'.format(json.dumps(user_name), records))
+    if not users:
+        return '{}'
+    return '{{\n{}\n}}'.format(',\n'.join(users))
+
+
+class ClusterRecord:
+    """
+    Purpose: A cluster record with the timestamps as epoch seconds, the
+    status as ClusterStatus and the low cardinality strings interned, the
+    keys without a slot are kept in extra. Records are immutable, updated()
+    returns a changed copy. The read methods of a dict (get, [], in, keys,
+    items) return the values of the JSON layout, so callers treat a record
+    like the dict it replaced.
+    """
+    __slots__ = ('name', 'type', 'region', 'version', 'status',
+                 'creation_time', 'expiration_time', 'extra')
+
+    def __init__(self, name=None, type=None, region=None, version=None,
+                 status=None, creation_time=None, expiration_time=None,
+                 extra=None):
+        self.name = name
+        self.type = type
+        self.region = region
+        self.version = version
+        self.status = status
+        self.creation_time = creation_time
+        self.expiration_time = expiration_time
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, cluster_info):
+        """
+        Decode a record of the JSON layout
+        :rtype: ClusterRecord
+        """
+        if isinstance(cluster_info, ClusterRecord):
+            return cluster_info
+        get = cluster_info.get
+        record = cls(get('name'), _intern(get('type')), _intern(get('region')),
+                     _intern(get('version')), parse_status(get('status')))
+        extra = None
+        for key in TIME_KEYS:
+            value = get(key)
+            if value is None:
+                continue
+            epoch = to_epoch(value)
+            setattr(record, key, epoch)
+            if epoch is None:
+                # a time which doesn't parse is kept as is
+                extra = extra or {}
+                extra[key] = value
+        if not _FIELDS.issuperset(cluster_info):
+            extra = extra or {}
+            for key, value in cluster_info.items():
+                if key not in _FIELDS:
+                    extra[key] = value
+        record.extra = extra
+        return record
+
+    def to_dict(self):
+        """
+        Encode the record into the JSON layout
+        :rtype: dict
+        """
+        data = {}
+        if self.name is not None:
+            data['name'] = self.name
+        if self.type is not None:
+            data['type'] = self.type
+        if self.region is not None:
+            data['region'] = self.region
+        if self.version is not None:
+            data['version'] = self.version
+        if self.status is not None:
+            data['status'] = str(self.status)
+        if self.creation_time is not None:
+            data['creation_time'] = format_time(self.creation_time)
+        if self.expiration_time is not None:
+            data['expiration_time'] = format_time(self.expiration_time)
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def updated(self, attribute_info):
+        """
+        :param attribute_info: attributes in the JSON layout
+        :return: copy of the record with the attributes applied
+        :rtype: ClusterRecord
+        """
+        record = ClusterRecord(self.name, self.type, self.region,
+                               self.version, self.status, self.creation_time,
+                               self.expiration_time, self.extra)
+        record._apply(attribute_info)
+        return record
+
+    def _apply(self, attribute_info):
+        # extra is shared with the copies, it gets copied before a change
+        extra = self.extra
+        copied = False
+        for key, value in attribute_info.items():
+            if key == 'name':
+                self.name = value
+                continue
+            if key == 'status':
+                self.status = parse_status(value)
+                continue
+            if key in INTERNED_KEYS:
+                setattr(self, key, _intern(value))
+                continue
+            if not copied:
+                extra = dict(extra) if extra else {}
+                copied = True
+            if key in TIME_KEYS:
+                epoch = to_epoch(value)
+                setattr(self, key, epoch)
+                if epoch is not None or value is None:
+                    extra.pop(key, None)
+                    continue
+            # a time which doesn't parse is kept as is
+            extra[key] = value
+        if copied:
+            self.extra = extra or None
+
+    def get(self, key, default=None):
+        if key in _FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return format_time(value) if key in TIME_KEYS else value
+        if self.extra:
+            return self.extra.get(key, default)
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __eq__(self, other):
+        if isinstance(other, ClusterRecord):
+            return self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+_FIELDS = frozenset(ClusterRecord.__slots__) - {'extra'}
+_MISSING = object()
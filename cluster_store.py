@@ -0,0 +1,1084 @@
+""" Storage backends for the cluster records of ClusterDbMgmt """
+
+import argparse
+import bisect
+import fcntl
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from types import MappingProxyType
+
+from cluster_record import ClusterRecord, encode_db
+from metrics import DB_PERSIST_BYTES, DB_PERSIST_DURATION
+
+logger = logging.getLogger(__name__)
+
+# 'json' rewrites the whole db file on every change, 'journal' appends the
+# change to <db_path>.journal and compacts it into the db file in background
+# and 'sqlite' keeps the records in a sqlite database in WAL mode
+PERSISTENCE_JSON = 'json'
+PERSISTENCE_JOURNAL = 'journal'
+PERSISTENCE_SQLITE = 'sqlite'
+JOURNAL_COMPACTION_THRESHOLD = 1000
+# loads of the json db by the sqlite import while the files keep changing
+IMPORT_LOAD_ATTEMPTS = 5
+DEFAULT_DB_PATHS = {PERSISTENCE_JSON: 'cluster_info.json',
+                    PERSISTENCE_JOURNAL: 'cluster_info.json',
+                    PERSISTENCE_SQLITE: 'cluster_info.db'}
+
+
+def remaining_hours(expirations):
+    """
+    :param expirations: iterable of (expiration epoch, cluster name)
+    :return: dictionary of cluster name and remaining hours
+    :rtype: dict
+    """
+    now = time.time()
+    return {name: str(int((exp_time - now) / 3600)) + " hrs"
+            for exp_time, name in expirations}
+
+
+def expiration_cutoff(exp_interval):
+    # remaining hours are truncated, so everything below
+    # exp_interval + 1 hours is reported
+    return time.time() + (exp_interval + 1) * 3600
+
+
+class ReadWriteLock:
+    """
+    Purpose: Many concurrent readers or a single writer. A waiting writer
+    holds back new readers so a stream of reads can't starve it. Not
+    reentrant.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read_lock(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class ClusterStore:
+    """
+    Purpose: Interface of the cluster record storage. Records are passed in
+    as dicts in the layout of cluster_info.json or as ClusterRecord and are
+    returned as ClusterRecord, the methods return the same status messages
+    ClusterDbMgmt always returned. Implementations are thread safe.
+    """
+
+    def refresh(self):
+        """
+        Pick up the changes other processes made to the db
+        :return: True when the records changed since the last call
+        :rtype: bool
+        """
+        return False
+
+    def reload(self):
+        """
+        Reload the records from the underlying storage
+        """
+        raise NotImplementedError
+
+    def get_cluster(self, user_name, cluster_name):
+        """
+        :return: cluster record or None
+        :rtype: ClusterRecord
+        """
+        raise NotImplementedError
+
+    def find_cluster(self, cluster_name):
+        """
+        Lookup a cluster record by its name only
+        :return: tuple of user name and cluster record, (None, None) if
+                 the cluster doesn't exist
+        :rtype: tuple
+        """
+        raise NotImplementedError
+
+    def update_cluster_info(self, user_name, cluster_info):
+        """
+        Insert a new cluster record of the user
+        """
+        raise NotImplementedError
+
+    def update_cluster_attribute(self, user_name, attribute_info):
+        """
+        Update the attributes of an existing cluster record.
+        :param user_name: owner of the cluster, if None the owner is
+                          resolved through the cluster name
+        :param attribute_info: dictionary of attributes with cluster name
+        """
+        raise NotImplementedError
+
+    def delete_record(self, user_id, cluster_name):
+        raise NotImplementedError
+
+    def get_clusters_by_user(self, user_name):
+        """
+        :return: list of cluster records, raises KeyError for an unknown
+                 user
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def get_clusters_by_status(self, *statuses):
+        """
+        :return: list of (user name, cluster record) in any of the statuses
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def snapshot(self):
+        """
+        Consistent read-only view of all the records
+        :return: mapping of user -> tuple of cluster records
+        :rtype: MappingProxyType
+        """
+        raise NotImplementedError
+
+    def get_expiring_clusters(self, exp_interval):
+        """
+        :param exp_interval: interval in hours to check the expiration
+        :return: dictionary of cluster name and remaining hours
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def get_expired_clusters(self):
+        """
+        :return: dictionary of already expired cluster names and the hours
+                 since their expiration (negative)
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def get_expiring_clusters_by_user(self, user_name, exp_interval):
+        """
+        Same as get_expiring_clusters but limited to the clusters of a user
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def batch(self):
+        """
+        Persist the changes made inside the with block at once instead of
+        one by one, other writers wait until the block is left
+        """
+        yield
+
+    def close(self):
+        pass
+
+
+class JsonClusterStore(ClusterStore):
+    """
+    Purpose: In-memory indexed records mirrored to cluster_info.json,
+    either rewritten on every change or through an append-only journal.
+
+    Writers are serialized by a writer lock which is held while persisting.
+    The indexes are guarded by a read/write lock which writers hold only
+    for the in-memory change, so reads don't wait on the disk. Records are
+    never changed in place (copy on write), readers get the record objects
+    and cached snapshots without copying.
+
+    A shared store is used by several processes (e.g. WSGI workers).
+    Writers then also hold an exclusive lock on <db_path>.lock and reload
+    the records first if the db files changed, reads reload only when the
+    files changed since the last load, which costs a few stat calls.
+
+    A read-only store loads the db files without writing them in any way,
+    so it can read the files of a live service: the journal isn't opened
+    for append, compacted or truncated, and changes aren't persisted.
+    """
+
+    def __init__(self, db_path='cluster_info.json',
+                 persistence=PERSISTENCE_JSON,
+                 compaction_threshold=JOURNAL_COMPACTION_THRESHOLD,
+                 shared=False, read_only=False):
+        if persistence not in (PERSISTENCE_JSON, PERSISTENCE_JOURNAL):
+            raise ValueError("unknown persistence mode {}".format(
+                persistence))
+        self.__db_path = db_path
+        self.__journal_path = db_path + '.journal'
+        self.__compacting_path = self.__journal_path + '.compacting'
+        self._persistence = persistence
+        self._compaction_threshold = compaction_threshold
+        self._journal_fp = None
+        self._journal_entries = 0
+        self._journal_lock = threading.Lock()
+        self._compaction_thread = None
+        self._write_lock = threading.RLock()
+        self._shared = shared
+        self._read_only = read_only
+        # process wide lock of the db files, only taken in shared mode and
+        # always with the write lock held
+        self._lock_fp = open(db_path + '.lock', 'a') if shared else None
+        self._file_locked = False
+        # stat of the db files as of the last load or own write
+        self._seen_stamp = None
+        # changes of a running batch, persisted when it ends
+        self._pending = None
+        self._rw_lock = ReadWriteLock()
+        # bumped on every change, tells whether the cached snapshot is stale
+        self._generation = 0
+        self._snapshot = None
+        # user -> cluster name -> ClusterRecord
+        self._user_index = {}
+        # cluster name -> tuple of (user, record) of all the owners, the
+        # latest added last, for callers which only know the cluster name
+        # (e.g. the jenkins /update callback). The tuples are replaced, not
+        # changed, so readers need no lock.
+        self._name_index = {}
+        # sorted (expiration epoch, user, cluster name) entries, globally
+        # and per user, the expiration time gets parsed only once
+        self._expiration_index = []
+        self._user_expiration_index = {}
+        self.reload()
+        # shared journals are opened per write, a compaction of another
+        # process would leave a kept open journal behind
+        if self._persistence == PERSISTENCE_JOURNAL and not self._shared \
+                and not self._read_only:
+            self._journal_fp = open(self.__journal_path, 'a')
+            if self._journal_entries >= self._compaction_threshold:
+                self._start_compaction()
+
+    @property
+    def _records(self):
+        """
+        Layout of the db i.e. user -> list of cluster records, cheap to take
+        as the records are never changed in place
+        """
+        return {user: list(clusters.values())
+                for user, clusters in self._user_index.items()}
+
+    def _stamp(self):
+        stamp = []
+        for path in (self.__db_path, self.__compacting_path,
+                     self.__journal_path):
+            try:
+                stat = os.stat(path)
+                stamp.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    @contextmanager
+    def _file_lock(self, operation):
+        """
+        flock the db files in shared mode, must be called with the write
+        lock held. Nested calls don't lock again, as flock would convert
+        the lock instead.
+        """
+        if not self._shared or self._file_locked:
+            yield
+            return
+        fcntl.flock(self._lock_fp, operation)
+        self._file_locked = True
+        try:
+            yield
+        finally:
+            self._file_locked = False
+            fcntl.flock(self._lock_fp, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _writing(self):
+        """
+        Serialize a change with the other writers, in shared mode also with
+        the ones of other processes, whose changes are loaded first
+        """
+        with self._write_lock, self._file_lock(fcntl.LOCK_EX):
+            if self._shared and self._stamp() != self._seen_stamp:
+                self._load()
+            yield
+            if self._shared:
+                self._seen_stamp = self._stamp()
+
+    def refresh(self):
+        if not self._shared or self._stamp() == self._seen_stamp:
+            return False
+        with self._write_lock:
+            if self._file_locked:
+                # a write of this process is in progress, it loaded the
+                # changes already
+                return False
+            with self._file_lock(fcntl.LOCK_SH):
+                if self._stamp() == self._seen_stamp:
+                    return False
+                self._load()
+        return True
+
+    def reload(self):
+        with self._write_lock, self._file_lock(fcntl.LOCK_SH):
+            return self._load()
+
+    def _load(self):
+        with self._write_lock:
+            if self._shared:
+                self._seen_stamp = self._stamp()
+            try:
+                with open(self.__db_path) as fp:
+                    db_data = json.load(fp)
+            except FileNotFoundError as e:
+                if self._persistence != PERSISTENCE_JOURNAL:
+                    logger.error('Exception found: %s', e)
+                    return None
+                # the journal holds everything until the first compaction
+                db_data = {}
+            except Exception as e:
+                logger.error('Exception found: %s', e)
+                if self._persistence != PERSISTENCE_JOURNAL:
+                    return None
+                db_data = {}
+            with self._rw_lock.write_lock():
+                self._build_indexes(db_data or {})
+                if self._persistence == PERSISTENCE_JOURNAL:
+                    # a journal left over by an interrupted compaction is
+                    # older than the active one, replaying is idempotent
+                    # either way
+                    self._journal_entries = 0
+                    for path in (self.__compacting_path,
+                                 self.__journal_path):
+                        self._journal_entries += self._replay_journal(path)
+                self._generation += 1
+            return self._records
+
+    def _build_indexes(self, db_data):
+        self._user_index = {}
+        self._name_index = {}
+        self._expiration_index = []
+        self._user_expiration_index = {}
+        for user_name, clusters in db_data.items():
+            self._user_index[user_name] = {}
+            for cluster in clusters:
+                self._add_to_indexes(user_name, cluster, sort=False)
+        self._expiration_index.sort()
+        for entries in self._user_expiration_index.values():
+            entries.sort()
+
+    def _add_to_indexes(self, user_name, cluster_info, sort=True):
+        record = ClusterRecord.from_dict(cluster_info)
+        user_name = sys.intern(user_name)
+        self._user_index.setdefault(user_name, {})[record.name] = record
+        self._name_index[record.name] = self._owners(record.name,
+                                                     user_name) + (
+            (user_name, record),)
+        self._add_expiration(user_name, record, sort)
+
+    def _remove_from_indexes(self, user_name, cluster_name):
+        cluster = self._user_index[user_name].pop(cluster_name)
+        owners = self._owners(cluster_name, user_name)
+        if owners:
+            self._name_index[cluster_name] = owners
+        else:
+            self._name_index.pop(cluster_name, None)
+        self._remove_expiration(user_name, cluster)
+        return cluster
+
+    def _owners(self, cluster_name, except_user=None):
+        """
+        :return: (user, record) of the owners of a cluster name but
+                 except_user
+        :rtype: tuple
+        """
+        return tuple(entry for entry in self._name_index.get(cluster_name, ())
+                     if entry[0] != except_user)
+
+    @staticmethod
+    def _expiration_entry(user_name, record):
+        if record.expiration_time is None:
+            return None
+        return record.expiration_time, user_name, record.name
+
+    def _add_expiration(self, user_name, cluster_info, sort=True):
+        entry = self._expiration_entry(user_name, cluster_info)
+        if entry is None:
+            return
+        user_entries = self._user_expiration_index.setdefault(user_name, [])
+        if sort:
+            bisect.insort(self._expiration_index, entry)
+            bisect.insort(user_entries, entry)
+        else:
+            self._expiration_index.append(entry)
+            user_entries.append(entry)
+
+    def _remove_expiration(self, user_name, cluster_info):
+        entry = self._expiration_entry(user_name, cluster_info)
+        if entry is None:
+            return
+        for entries in (self._expiration_index,
+                        self._user_expiration_index.get(user_name, [])):
+            index = bisect.bisect_left(entries, entry)
+            if index < len(entries) and entries[index] == entry:
+                entries.pop(index)
+
+    def get_cluster(self, user_name, cluster_name):
+        self.refresh()
+        # single dict lookups are atomic, no need for the read lock
+        return self._user_index.get(user_name, {}).get(cluster_name)
+
+    def find_cluster(self, cluster_name):
+        self.refresh()
+        owners = self._name_index.get(cluster_name)
+        # like the sqlite store, the latest added cluster of the name wins
+        return owners[-1] if owners else (None, None)
+
+    def update_cluster_attribute(self, user_name, attribute_info):
+        with self._writing():
+            if user_name is None:
+                user_name, _ = self.find_cluster(attribute_info.get('name'))
+            if user_name not in self._user_index:
+                return "username doesn't exist"
+            cluster = self.get_cluster(user_name,
+                                       attribute_info.get('name'))
+            if cluster is None:
+                return "cluster doesn't exist"
+            with self._rw_lock.write_lock():
+                self._update_record(user_name, cluster, attribute_info)
+                self._generation += 1
+            self._persist({'op': 'update', 'user': user_name,
+                           'cluster': attribute_info})
+        return "success"
+
+    def _update_record(self, user_name, cluster, attribute_info):
+        updated = cluster.updated(attribute_info)
+        cluster_name = cluster.name
+        self._user_index[user_name][cluster_name] = updated
+        self._name_index[cluster_name] = tuple(
+            (user_name, updated) if entry[0] == user_name else entry
+            for entry in self._name_index.get(cluster_name, ()))
+        if 'expiration_time' in attribute_info:
+            self._remove_expiration(user_name, cluster)
+            self._add_expiration(user_name, updated)
+
+    @staticmethod
+    def _entries_before(entries, cutoff):
+        """
+        (expiration epoch, cluster name) of a sorted expiration index which
+        expire before cutoff
+        """
+        return [(exp_time, name) for exp_time, _, name in
+                entries[:bisect.bisect_left(entries, (cutoff,))]]
+
+    def get_expiring_clusters(self, exp_interval):
+        self.refresh()
+        with self._rw_lock.read_lock():
+            entries = self._entries_before(self._expiration_index,
+                                           expiration_cutoff(exp_interval))
+        return remaining_hours(entries)
+
+    def get_expired_clusters(self):
+        self.refresh()
+        with self._rw_lock.read_lock():
+            entries = self._entries_before(self._expiration_index,
+                                           time.time() + 1e-6)
+        return remaining_hours(entries)
+
+    def get_expiring_clusters_by_user(self, user_name, exp_interval):
+        self.refresh()
+        with self._rw_lock.read_lock():
+            entries = self._entries_before(
+                self._user_expiration_index.get(user_name, []),
+                expiration_cutoff(exp_interval))
+        return remaining_hours(entries)
+
+    def update_cluster_info(self, user_name, cluster_info):
+        record = ClusterRecord.from_dict(cluster_info)
+        with self._writing():
+            if self.get_cluster(user_name, record.name) is not None:
+                return 'cluster already exist'
+            with self._rw_lock.write_lock():
+                self._add_to_indexes(user_name, record)
+                self._generation += 1
+            logger.debug("updated data for user %s: %s", user_name, record)
+            self._persist({'op': 'put', 'user': user_name,
+                           'cluster': record.to_dict()})
+        return 'success'
+
+    def delete_record(self, user_id, cluster_name):
+        with self._writing():
+            if self.get_cluster(user_id, cluster_name) is None:
+                return "cluster name/user id not found"
+            with self._rw_lock.write_lock():
+                self._remove_from_indexes(user_id, cluster_name)
+                self._generation += 1
+            self._persist({'op': 'delete', 'user': user_id,
+                           'name': cluster_name})
+        return "cluster deletion initiated"
+
+    def get_clusters_by_user(self, user_name):
+        self.refresh()
+        with self._rw_lock.read_lock():
+            return list(self._user_index[user_name].values())
+
+    def get_clusters_by_status(self, *statuses):
+        return [(user_name, cluster)
+                for user_name, clusters in self.snapshot().items()
+                for cluster in clusters
+                if cluster.get('status') in statuses]
+
+    def snapshot(self):
+        self.refresh()
+        cached = self._snapshot
+        if cached is not None and cached[0] == self._generation:
+            return cached[1]
+        with self._rw_lock.read_lock():
+            generation = self._generation
+            snapshot = MappingProxyType(
+                {user: tuple(clusters.values())
+                 for user, clusters in self._user_index.items()})
+        self._snapshot = (generation, snapshot)
+        return snapshot
+
+    @contextmanager
+    def batch(self):
+        with self._writing():
+            if self._pending is not None:
+                yield
+                return
+            self._pending = []
+            try:
+                yield
+            finally:
+                # the changes are applied in memory already, persist them
+                # even if the block failed half way
+                changes, self._pending = self._pending, None
+                if changes:
+                    self._persist_changes(changes)
+
+    def _persist(self, change):
+        """
+        Persist a single change of the db as per the persistence mode
+        :param change: journal entry with op (put/update/delete), user and
+                       the cluster record/attributes or cluster name
+        """
+        if self._pending is not None:
+            self._pending.append(change)
+            return None
+        return self._persist_changes([change])
+
+    def _persist_changes(self, changes):
+        if self._read_only:
+            logger.error('Not persisting changes of the read-only store %s',
+                         self.__db_path)
+            return 'failed'
+        if self._persistence != PERSISTENCE_JOURNAL:
+            return self.update_db()
+        try:
+            with DB_PERSIST_DURATION.labels(self._persistence,
+                                            'serialize').time():
+                lines = ''.join(json.dumps(change) + '\n'
+                                for change in changes)
+            with self._journal_lock, DB_PERSIST_DURATION.labels(
+                    self._persistence, 'write').time():
+                if self._shared:
+                    with open(self.__journal_path, 'a') as fp:
+                        self._append(fp, lines)
+                else:
+                    self._append(self._journal_fp, lines)
+                DB_PERSIST_BYTES.labels(self._persistence).inc(len(lines))
+                self._journal_entries += len(changes)
+                if self._journal_entries >= self._compaction_threshold:
+                    self._start_compaction()
+        except (FileNotFoundError, Exception) as e:
+            logger.error('Exception found: %s', e)
+            return 'failed'
+
+    @staticmethod
+    def _append(fp, line):
+        fp.write(line)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    def _apply_change(self, change):
+        user_name = change.get('user')
+        if change['op'] == 'put':
+            cluster_name = change['cluster'].get('name')
+            if self.get_cluster(user_name, cluster_name) is not None:
+                self._remove_from_indexes(user_name, cluster_name)
+            self._add_to_indexes(user_name, change['cluster'])
+        elif change['op'] == 'update':
+            cluster = self.get_cluster(user_name,
+                                       change['cluster'].get('name'))
+            if cluster is not None:
+                self._update_record(user_name, cluster, change['cluster'])
+        elif change['op'] == 'delete':
+            if self.get_cluster(user_name, change['name']) is not None:
+                self._remove_from_indexes(user_name, change['name'])
+
+    def _replay_journal(self, path):
+        """
+        Apply the changes of a journal file on the loaded db
+        :return: number of replayed changes
+        :rtype: int
+        """
+        count = 0
+        offset = 0
+        try:
+            with open(path, 'rb') as fp:
+                for line in fp:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        if line.endswith(b'\n'):
+                            # garbled entry, the entries after it were
+                            # appended later and still apply
+                            logger.warning('Skipping unreadable journal '
+                                           'entry in %s at offset %s',
+                                           path, offset)
+                            offset += len(line)
+                            continue
+                        if self._read_only:
+                            # may be an append of the live writer which is
+                            # still in progress
+                            break
+                        # torn write of a crash, the next append would be
+                        # glued to it and get lost with it on the next
+                        # replay
+                        logger.warning('Dropping incomplete journal entry '
+                                       'in %s at offset %s', path, offset)
+                        os.truncate(path, offset)
+                        break
+                    self._apply_change(change)
+                    count += 1
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+        return count
+
+    def _start_compaction(self):
+        """
+        Rotate the journal and write a snapshot of the db in background.
+        Must be called with the journal lock held.
+        """
+        if self._compaction_thread and self._compaction_thread.is_alive():
+            return
+        # records are copied on write, so the snapshot stays stable while
+        # the store keeps changing, it is encoded by the compaction
+        snapshot = self._records
+        if self._journal_fp:
+            self._journal_fp.close()
+        if os.path.exists(self.__compacting_path):
+            # the previous compaction failed, keep its changes until a
+            # snapshot covering them got written
+            with open(self.__journal_path) as src, \
+                    open(self.__compacting_path, 'a') as dst:
+                dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.__journal_path)
+        else:
+            os.replace(self.__journal_path, self.__compacting_path)
+        self._journal_entries = 0
+        if self._shared:
+            # the files are locked by this process for the duration of the
+            # change only, a compaction running past it could remove the
+            # changes of another process with the compacted journal
+            self._compact(snapshot)
+            return
+        self._journal_fp = open(self.__journal_path, 'a')
+        self._compaction_thread = threading.Thread(
+            target=self._compact, args=(snapshot,), daemon=True)
+        self._compaction_thread.start()
+
+    def _compact(self, snapshot):
+        if self._write_snapshot(snapshot) is None:
+            os.remove(self.__compacting_path)
+
+    def _write_snapshot(self, db_data):
+        """
+        Atomically replace the db file with db_data
+        :param db_data: user -> list of cluster records
+        """
+        try:
+            with DB_PERSIST_DURATION.labels(PERSISTENCE_JSON,
+                                            'serialize').time():
+                data = encode_db(db_data)
+            tmp_path = self.__db_path + '.tmp'
+            with DB_PERSIST_DURATION.labels(PERSISTENCE_JSON,
+                                            'write').time():
+                with open(tmp_path, 'w') as fp:
+                    fp.write(data)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(tmp_path, self.__db_path)
+            DB_PERSIST_BYTES.labels(PERSISTENCE_JSON).inc(len(data))
+        except (FileNotFoundError, Exception) as e:
+            logger.error('Exception found: %s', e)
+            return 'failed'
+
+    def update_db(self):
+        with self._writing():
+            return self._write_snapshot(self._records)
+
+    def close(self):
+        """
+        Wait for a running compaction and close the journal
+        """
+        if self._compaction_thread:
+            self._compaction_thread.join()
+        with self._journal_lock:
+            if self._journal_fp:
+                self._journal_fp.close()
+                self._journal_fp = None
+        if self._lock_fp:
+            self._lock_fp.close()
+            self._lock_fp = None
+
+
+class _ThreadConnection:
+    """
+    Purpose: Holder of the sqlite connection of a thread, kept in the
+    thread local storage only. It goes away with the thread, which closes
+    the connection.
+    """
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn):
+        self.conn = conn
+        weakref.finalize(self, conn.close)
+
+
+class SqliteClusterStore(ClusterStore):
+    """
+    Purpose: Cluster records in a sqlite database in WAL mode. Every thread
+    gets its own connection, closed when the thread ends, readers don't
+    block the writer and vice versa.
+    The full record is kept as JSON next to the indexed columns. Queries
+    read the database, so several processes can share it as is.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS clusters (
+            user TEXT NOT NULL,
+            name TEXT NOT NULL,
+            status TEXT,
+            expiration_time REAL,
+            record TEXT NOT NULL,
+            UNIQUE (user, name)
+        );
+        CREATE INDEX IF NOT EXISTS clusters_name ON clusters (name);
+        CREATE INDEX IF NOT EXISTS clusters_status ON clusters (status);
+        CREATE INDEX IF NOT EXISTS clusters_expiration
+            ON clusters (expiration_time);
+    '''
+    # statements are kept constant so the sqlite3 statement cache of each
+    # connection serves them as prepared statements
+    SELECT_CLUSTER = 'SELECT record FROM clusters WHERE user = ? AND name = ?'
+    FIND_CLUSTER = ('SELECT user, record FROM clusters WHERE name = ? '
+                    'ORDER BY rowid DESC LIMIT 1')
+    USER_EXISTS = 'SELECT 1 FROM clusters WHERE user = ? LIMIT 1'
+    INSERT_CLUSTER = ('INSERT INTO clusters (user, name, status, '
+                      'expiration_time, record) VALUES (?, ?, ?, ?, ?)')
+    UPSERT_CLUSTER = ('INSERT OR REPLACE INTO clusters (user, name, status, '
+                      'expiration_time, record) VALUES (?, ?, ?, ?, ?)')
+    UPDATE_CLUSTER = ('UPDATE clusters SET status = ?, expiration_time = ?, '
+                      'record = ? WHERE user = ? AND name = ?')
+    DELETE_CLUSTER = 'DELETE FROM clusters WHERE user = ? AND name = ?'
+    SELECT_BY_USER = 'SELECT record FROM clusters WHERE user = ? ORDER BY rowid'
+    SELECT_ALL = 'SELECT user, record FROM clusters ORDER BY rowid'
+    SELECT_EXPIRING = ('SELECT expiration_time, name FROM clusters '
+                       'WHERE expiration_time < ? ORDER BY expiration_time')
+    SELECT_EXPIRING_BY_USER = ('SELECT expiration_time, name FROM clusters '
+                               'WHERE user = ? AND expiration_time < ? '
+                               'ORDER BY expiration_time')
+
+    def __init__(self, db_path='cluster_info.db', timeout=30):
+        self.__db_path = db_path
+        self._timeout = timeout
+        self._local = threading.local()
+        # connections of the live threads, for close()
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+        # data_version of a connection only changes with the commits of the
+        # other connections, commits of this store are counted here
+        self._commits = itertools.count()
+        self._commit_count = 0
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(self.SCHEMA)
+
+    def _connection(self):
+        holder = getattr(self._local, 'conn', None)
+        if holder is None:
+            conn = sqlite3.connect(self.__db_path, timeout=self._timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            holder = self._local.conn = _ThreadConnection(conn)
+            with self._connections_lock:
+                self._connections.add(holder)
+        return holder.conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        if getattr(self._local, 'batch', False):
+            # part of the transaction of a batch
+            yield conn
+            return
+        with DB_PERSIST_DURATION.labels(PERSISTENCE_SQLITE,
+                                        'transaction').time():
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            self._commit_count = next(self._commits) + 1
+
+    @contextmanager
+    def batch(self):
+        if getattr(self._local, 'batch', False):
+            yield
+            return
+        conn = self._connection()
+        with DB_PERSIST_DURATION.labels(PERSISTENCE_SQLITE,
+                                        'transaction').time():
+            conn.execute('BEGIN IMMEDIATE')
+            self._local.batch = True
+            try:
+                yield
+            finally:
+                self._local.batch = False
+                # like the json store, the changes made before a failure
+                # are kept
+                conn.execute('COMMIT')
+                self._commit_count = next(self._commits) + 1
+
+    @staticmethod
+    def _row(user_name, cluster_info):
+        record = ClusterRecord.from_dict(cluster_info)
+        status = str(record.status) if record.status is not None else None
+        return (user_name, record.name, status, record.expiration_time,
+                json.dumps(record.to_dict()))
+
+    @staticmethod
+    def _record(data):
+        return ClusterRecord.from_dict(json.loads(data))
+
+    def _data_version(self):
+        conn = self._connection()
+        return (conn.execute('PRAGMA data_version').fetchone()[0],
+                self._commit_count)
+
+    def refresh(self):
+        version = self._data_version()
+        changed = version != getattr(self._local, 'refreshed', None)
+        self._local.refreshed = version
+        return changed
+
+    def reload(self):
+        # every query reads the database, there is nothing cached
+        return None
+
+    def get_cluster(self, user_name, cluster_name):
+        row = self._connection().execute(
+            self.SELECT_CLUSTER, (user_name, cluster_name)).fetchone()
+        return self._record(row[0]) if row else None
+
+    def find_cluster(self, cluster_name):
+        row = self._connection().execute(self.FIND_CLUSTER,
+                                         (cluster_name,)).fetchone()
+        if not row:
+            return None, None
+        return row[0], self._record(row[1])
+
+    def update_cluster_info(self, user_name, cluster_info):
+        try:
+            with self._transaction() as conn:
+                conn.execute(self.INSERT_CLUSTER,
+                             self._row(user_name, cluster_info))
+        except sqlite3.IntegrityError:
+            return 'cluster already exist'
+        return 'success'
+
+    def update_cluster_attribute(self, user_name, attribute_info):
+        if user_name is None:
+            user_name, _ = self.find_cluster(attribute_info.get('name'))
+        with self._transaction() as conn:
+            if not conn.execute(self.USER_EXISTS, (user_name,)).fetchone():
+                return "username doesn't exist"
+            row = conn.execute(
+                self.SELECT_CLUSTER,
+                (user_name, attribute_info.get('name'))).fetchone()
+            if not row:
+                return "cluster doesn't exist"
+            cluster = self._record(row[0]).updated(attribute_info)
+            _, name, status, exp_epoch, record = self._row(user_name,
+                                                           cluster)
+            conn.execute(self.UPDATE_CLUSTER,
+                         (status, exp_epoch, record, user_name, name))
+        return "success"
+
+    def delete_record(self, user_id, cluster_name):
+        with self._transaction() as conn:
+            deleted = conn.execute(self.DELETE_CLUSTER,
+                                   (user_id, cluster_name)).rowcount
+        if not deleted:
+            return "cluster name/user id not found"
+        return "cluster deletion initiated"
+
+    def get_clusters_by_user(self, user_name):
+        rows = self._connection().execute(self.SELECT_BY_USER,
+                                          (user_name,)).fetchall()
+        if not rows:
+            raise KeyError(user_name)
+        return [self._record(row[0]) for row in rows]
+
+    def get_clusters_by_status(self, *statuses):
+        if not statuses:
+            return []
+        rows = self._connection().execute(
+            'SELECT user, record FROM clusters WHERE status IN ({}) '
+            'ORDER BY rowid'.format(', '.join('?' * len(statuses))),
+            [str(status) for status in statuses]).fetchall()
+        return [(row[0], self._record(row[1])) for row in rows]
+
+    def snapshot(self):
+        # taken before the query, a commit in between only makes the next
+        # call rebuild the snapshot
+        version = self._data_version()
+        cached = getattr(self._local, 'snapshot', None)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        # a single statement reads one consistent WAL snapshot
+        snapshot = {}
+        for user_name, record in self._connection().execute(
+                self.SELECT_ALL):
+            snapshot.setdefault(user_name, []).append(self._record(record))
+        snapshot = MappingProxyType({user_name: tuple(clusters)
+                                     for user_name, clusters in
+                                     snapshot.items()})
+        self._local.snapshot = (version, snapshot)
+        return snapshot
+
+    def get_expiring_clusters(self, exp_interval):
+        return remaining_hours(self._connection().execute(
+            self.SELECT_EXPIRING, (expiration_cutoff(exp_interval),)))
+
+    def get_expired_clusters(self):
+        return remaining_hours(self._connection().execute(
+            self.SELECT_EXPIRING, (time.time() + 1e-6,)))
+
+    def get_expiring_clusters_by_user(self, user_name, exp_interval):
+        return remaining_hours(self._connection().execute(
+            self.SELECT_EXPIRING_BY_USER,
+            (user_name, expiration_cutoff(exp_interval))))
+
+    def import_records(self, db_data):
+        """
+        Insert or replace the records of a cluster_info.json layout in one
+        transaction, importing the same data again is harmless.
+        :return: number of imported records
+        :rtype: int
+        """
+        rows = [self._row(user_name, cluster)
+                for user_name, clusters in db_data.items()
+                for cluster in clusters]
+        with self._transaction() as conn:
+            conn.executemany(self.UPSERT_CLUSTER, rows)
+        return len(rows)
+
+    def close(self):
+        with self._connections_lock:
+            for holder in list(self._connections):
+                holder.conn.close()
+            self._connections = weakref.WeakSet()
+        self._local = threading.local()
+
+
+def create_store(persistence=PERSISTENCE_JSON, db_path=None, shared=False,
+                 **kwargs):
+    """
+    Create the storage backend of a persistence mode
+    :param persistence: one of json, journal or sqlite
+    :param db_path: path of the db, defaults as per the persistence mode
+    :param shared: the db is used by several processes at once
+    """
+    if persistence not in DEFAULT_DB_PATHS:
+        raise ValueError("unknown persistence mode {}".format(persistence))
+    db_path = db_path or DEFAULT_DB_PATHS[persistence]
+    if persistence == PERSISTENCE_SQLITE:
+        return SqliteClusterStore(db_path, **kwargs)
+    return JsonClusterStore(db_path, persistence=persistence, shared=shared,
+                            **kwargs)
+
+
+def import_json_to_sqlite(json_path, sqlite_path,
+                          persistence=PERSISTENCE_JSON):
+    """
+    One-shot migration of cluster_info.json (and its journal in journal
+    mode) into a sqlite db. The files are only read, so it can run next to
+    the live service and be repeated right before switching DB_PERSISTENCE
+    to sqlite. Changes of the service made while it runs may be missed.
+    :return: number of imported records
+    :rtype: int
+    """
+    json_store = JsonClusterStore(json_path, persistence=persistence,
+                                  read_only=True)
+    # a compaction of the service between reading the db file and the
+    # journals could hide records, load again until the files stay put
+    for _ in range(IMPORT_LOAD_ATTEMPTS):
+        stamp = json_store._stamp()
+        json_store.reload()
+        if json_store._stamp() == stamp:
+            break
+    json_store.close()
+    sqlite_store = SqliteClusterStore(sqlite_path)
+    try:
+        return sqlite_store.import_records(json_store._records)
+    finally:
+        sqlite_store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Import cluster_info.json into a sqlite cluster db')
+    parser.add_argument('json_path', nargs='?',
+                        default=DEFAULT_DB_PATHS[PERSISTENCE_JSON])
+    parser.add_argument('sqlite_path', nargs='?',
+                        default=DEFAULT_DB_PATHS[PERSISTENCE_SQLITE])
+    parser.add_argument('--persistence', default=PERSISTENCE_JSON,
+                        choices=[PERSISTENCE_JSON, PERSISTENCE_JOURNAL])
+    args = parser.parse_args()
+    print('imported {} cluster records'.format(import_json_to_sqlite(
+        args.json_path, args.sqlite_path, args.persistence)))
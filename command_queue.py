@@ -0,0 +1,100 @@
+""" Asynchronous execution of slash commands with response_url follow-up """
+
+import logging
+import queue
+import threading
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+COMMAND_QUEUE_DEPTH = 100
+COMMAND_WORKERS = 4
+RESPONSE_TIMEOUT = 10
+
+
+class CommandQueue:
+    """
+    Purpose: Run slow slash commands (e.g. jenkins triggers) on a bounded
+    pool of worker threads, so the slack request can be acknowledged right
+    away. The result of a command is posted to the slack response_url.
+    """
+
+    def __init__(self, max_depth=COMMAND_QUEUE_DEPTH, workers=COMMAND_WORKERS,
+                 response_timeout=RESPONSE_TIMEOUT):
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._workers = workers
+        self._response_timeout = response_timeout
+        self._threads = []
+
+    def start(self):
+        for index in range(self._workers):
+            thread = threading.Thread(target=self._worker, daemon=True,
+                                      name='command-worker-{}'.format(index))
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, response_url, func, *args, **kwargs):
+        """
+        Queue a command without waiting for it
+        :param response_url: slack response_url of the slash command, the
+                             result of func is posted to it
+        :param func: callable returning the message for the user
+        :return: False when the queue is full
+        :rtype: bool
+        """
+        try:
+            self._queue.put_nowait((response_url, func, args, kwargs))
+            return True
+        except queue.Full:
+            return False
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def join(self):
+        """
+        Wait until every queued command got executed and answered
+        """
+        self._queue.join()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            response_url, func, args, kwargs = job
+            try:
+                message = func(*args, **kwargs)
+            except Exception as e:
+                logger.error('Exception found: %s', e)
+                message = "exception occurred"
+            try:
+                self.respond(response_url, message)
+            finally:
+                self._queue.task_done()
+
+    def respond(self, response_url, message):
+        if not response_url:
+            logger.warning('no response_url, dropping result: %s', message)
+            return
+        try:
+            ret = requests.post(response_url,
+                                json={"response_type": "ephemeral",
+                                      "text": str(message)},
+                                timeout=self._response_timeout)
+            if ret.status_code != 200:
+                logger.warning('response_url returned: %s', ret.status_code)
+        except requests.RequestException as e:
+            logger.error('Exception found: %s', e)
+
+    def stop(self, timeout=None):
+        """
+        Let the workers finish the queued commands and exit
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
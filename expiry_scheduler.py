@@ -0,0 +1,221 @@
+""" Event driven cluster expiration warnings """
+
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# hours before the expiration a cluster is announced, 0 is the expiration
+EXPIRY_WARNINGS = (24, 1, 0)
+# upper bound of a single wait, so wall clock jumps are noticed
+MAX_WAIT = 300
+LEADER_LOCK_PATH = 'expiry_scheduler.lock'
+SYNC_INTERVAL = 5
+
+
+class ExpiryScheduler:
+    """
+    Purpose: Announce every cluster once per warning threshold at the time
+    it is reached. Armed clusters sit in a heap of (due time, cluster,
+    threshold) and one timer thread sleeps until the earliest entry, so
+    idle cost doesn't depend on the number of clusters. Re-arming or
+    cancelling a cluster bumps its version, entries of an older version
+    are dropped when they come up. The announced thresholds are only kept
+    in memory, so the thresholds which passed before a cluster got armed
+    (e.g. while the service was down) are skipped rather than announced on
+    every start.
+    """
+
+    def __init__(self, callback, warnings=EXPIRY_WARNINGS):
+        """
+        :param callback: called as callback(user_name, cluster_name,
+                         hours, expiration) when a threshold is reached,
+                         hours is the threshold and expiration the epoch
+                         seconds the cluster expires at
+        :param warnings: thresholds in hours before the expiration
+        """
+        self._callback = callback
+        self._warnings = tuple(sorted(set(warnings), reverse=True))
+        self._cond = threading.Condition()
+        self._heap = []
+        # (user, cluster name) -> [version, expiration, announced hours]
+        self._armed = {}
+        self._versions = itertools.count()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, daemon=True,
+                                        name='expiry-scheduler')
+        self._thread.start()
+
+    def arm(self, user_name, cluster_name, expiration):
+        """
+        Schedule the warnings of a cluster, replacing its earlier ones.
+        Arming a cluster again with the same expiration changes nothing, the
+        thresholds passed already aren't announced.
+        :param expiration: epoch seconds the cluster expires at
+        """
+        key = (user_name, cluster_name)
+        now = time.time()
+        with self._cond:
+            state = self._armed.get(key)
+            if state is not None and state[1] == expiration:
+                return
+            version = next(self._versions)
+            self._armed[key] = [version, expiration, set()]
+            for hours in self._warnings:
+                due = expiration - hours * 3600
+                if due > now:
+                    heapq.heappush(self._heap, (due, version, key, hours))
+            self._compact()
+            self._cond.notify()
+
+    def cancel(self, user_name, cluster_name):
+        with self._cond:
+            if self._armed.pop((user_name, cluster_name), None) is not None:
+                self._compact()
+
+    def retain(self, keys):
+        """
+        Cancel the clusters which aren't in keys
+        :param keys: set of (user name, cluster name)
+        """
+        with self._cond:
+            for key in [key for key in self._armed if key not in keys]:
+                del self._armed[key]
+            self._compact()
+
+    def armed(self):
+        with self._cond:
+            return len(self._armed)
+
+    def _compact(self):
+        # dropped entries stay in the heap until they are due, rebuild
+        # it once they dominate
+        if len(self._heap) > 2 * len(self._armed) * len(self._warnings) + 64:
+            self._heap = [entry for entry in self._heap
+                          if self._is_current(entry)]
+            heapq.heapify(self._heap)
+
+    def _is_current(self, entry):
+        state = self._armed.get(entry[2])
+        return state is not None and state[0] == entry[1]
+
+    def _next_due(self):
+        """
+        Wait for the next due warning
+        :return: (user, cluster name, hours, expiration), None once stopped
+        """
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due, version, key, hours = self._heap[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self._cond.wait(min(delay, MAX_WAIT))
+                    continue
+                heapq.heappop(self._heap)
+                state = self._armed.get(key)
+                if state is None or state[0] != version:
+                    continue
+                # the state is kept after the last warning, so re-arming
+                # with the same expiration doesn't announce it again
+                state[2].add(hours)
+                return key[0], key[1], hours, state[1]
+            return None
+
+    def _worker(self):
+        while True:
+            due = self._next_due()
+            if due is None:
+                return
+            try:
+                self._callback(*due)
+            except Exception as e:
+                logger.error('Exception found: %s', e)
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+class ExpiryLeader:
+    """
+    Purpose: Run the expiry scheduler in exactly one of several worker
+    processes sharing the db. The process holding the lock file arms the
+    scheduler and re-arms it every sync_interval from the records the
+    other workers wrote, the others keep trying to take the lock, so one
+    of them takes over when the leader exits.
+    """
+
+    def __init__(self, cluster_db, scheduler, lock_path=LEADER_LOCK_PATH,
+                 sync_interval=SYNC_INTERVAL, on_elected=None):
+        """
+        :param cluster_db: ClusterDbMgmt the scheduler is armed from
+        :param on_elected: called once this process became the leader, to
+                           start other services which must run only once
+        """
+        self._cluster_db = cluster_db
+        self._on_elected = on_elected
+        self._scheduler = scheduler
+        self._lock_path = lock_path
+        self._sync_interval = sync_interval
+        self._lock_fp = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return self._lock_fp is not None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, daemon=True,
+                                        name='expiry-leader')
+        self._thread.start()
+
+    def _try_lock(self):
+        fp = open(self._lock_path, 'a')
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fp.close()
+            return False
+        self._lock_fp = fp
+        return True
+
+    def _worker(self):
+        while True:
+            try:
+                if self.is_leader:
+                    self._cluster_db.sync_expiry_scheduler()
+                elif self._try_lock():
+                    logger.info('process %s runs the expiry scheduler',
+                                os.getpid())
+                    self._cluster_db.set_expiry_scheduler(self._scheduler)
+                    self._scheduler.start()
+                    if self._on_elected:
+                        self._on_elected()
+            except Exception as e:
+                logger.error('Exception found: %s', e)
+            if self._stopped.wait(self._sync_interval):
+                return
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout)
+        if self.is_leader:
+            self._scheduler.stop(timeout)
+            self._lock_fp.close()
+            self._lock_fp = None
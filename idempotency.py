@@ -0,0 +1,135 @@
+""" Deduplication of retried and repeated requests """
+
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import DUPLICATE_REQUESTS
+
+DEDUP_TTL = 300
+DEDUP_MAX_ENTRIES = 10000
+# how long a duplicate waits for the original request to finish
+DUPLICATE_WAIT = 2.5
+
+
+class _Entry:
+    __slots__ = ('expires', 'done', 'result')
+
+    def __init__(self, expires):
+        self.expires = expires
+        self.done = threading.Event()
+        self.result = None
+
+
+class IdempotencyCache:
+    """
+    Purpose: Remember the results of requests by their identity for ttl
+    seconds, so a duplicate (a slack retry, a repeated jenkins callback)
+    gets the original result without the work being done again. A
+    duplicate arriving while the original still runs waits for it up to
+    duplicate_wait and gets pending_result after that. At most
+    max_entries results are kept, the least recently used go first.
+    Failed requests and results rejected by should_cache are forgotten,
+    so a retry runs again.
+    """
+
+    def __init__(self, ttl=DEDUP_TTL, max_entries=DEDUP_MAX_ENTRIES,
+                 duplicate_wait=DUPLICATE_WAIT, pending_result=None,
+                 should_cache=None):
+        """
+        :param should_cache: called as should_cache(key, result), a result
+                             it returns False for isn't kept, e.g. a
+                             transient error
+        """
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._duplicate_wait = duplicate_wait
+        self._pending_result = pending_result
+        self._should_cache = should_cache
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def run(self, key, func, *args, **kwargs):
+        """
+        Call func unless a request with the same key ran within ttl
+        :param key: tuple identifying the request, its first item names
+                    the endpoint in the metrics
+        :return: result of func, of the original request for duplicates
+        """
+        entry, duplicate = self._claim(key)
+        if duplicate:
+            if entry.done.wait(self._duplicate_wait):
+                return entry.result
+            return self._pending_result
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            # a failed request may be retried, duplicates waiting for it
+            # get the pending result
+            self.complete(key, entry, failed=True)
+            raise
+        self.complete(key, entry, result)
+        return result
+
+    def claim(self, key):
+        """
+        Same as run, but for callers which run the request themselves and
+        mustn't wait for a running duplicate
+        :return: tuple of a ticket and None if the caller has to run the
+                 request and pass the ticket to complete() afterwards,
+                 otherwise None and the result of the original request
+                 (pending_result while it still runs)
+        :rtype: tuple
+        """
+        entry, duplicate = self._claim(key)
+        if not duplicate:
+            return entry, None
+        return None, entry.result if entry.done.is_set() \
+            else self._pending_result
+
+    def complete(self, key, ticket, result=None, failed=False):
+        """
+        Record the result of a request claimed with claim()
+        :param failed: the request failed and may be retried
+        """
+        if failed:
+            result = self._pending_result
+        ticket.result = result
+        if failed or (self._should_cache and
+                      not self._should_cache(key, result)):
+            self._forget(key, ticket)
+        # the ttl counts from the result on
+        ticket.expires = time.monotonic() + self._ttl
+        ticket.done.set()
+
+    def _claim(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                entry = self._entries[key] = _Entry(now + self._ttl)
+                self._evict(now)
+                return entry, False
+            self._entries.move_to_end(key)
+        DUPLICATE_REQUESTS.labels(key[0]).inc()
+        return entry, True
+
+    def _forget(self, key, entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+
+    def _evict(self, now):
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if oldest.expires > now:
+                break
+            self._entries.popitem(last=False)
@@ -0,0 +1,149 @@
+""" Long-lived Jenkins REST client """
+
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import JENKINS_REQUEST_DURATION, JENKINS_RESPONSES
+
+JENKINS_CONNECT_TIMEOUT = 5
+JENKINS_READ_TIMEOUT = 30
+JENKINS_RETRIES = 3
+JENKINS_BACKOFF = 0.5
+JENKINS_POOL_SIZE = 10
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+# methods retried after read errors and RETRY_STATUS_CODES, urllib3 retries
+# connect errors of any method
+RETRY_METHODS = frozenset(['GET', 'HEAD'])
+
+
+class JenkinsClient:
+    """
+    Purpose: Jenkins client keeping a pooled keep-alive session, so builds
+    don't pay a TCP+TLS handshake each. Requests have connect/read
+    timeouts, GETs are retried with backoff on connection errors and 5xx,
+    POSTs only on connect errors so a build isn't triggered twice, and the
+    CSRF crumb is fetched once per Jenkins instance.
+    """
+
+    def __init__(self, user=None, password=None,
+                 connect_timeout=JENKINS_CONNECT_TIMEOUT,
+                 read_timeout=JENKINS_READ_TIMEOUT, retries=JENKINS_RETRIES,
+                 backoff=JENKINS_BACKOFF, pool_size=JENKINS_POOL_SIZE):
+        user = user or os.environ.get('JENKINS_USER')
+        password = password or os.environ.get('JENKINS_PWD')
+        self._timeout = (connect_timeout, read_timeout)
+        self._session = requests.Session()
+        if user:
+            self._session.auth = (user, password)
+        # a POST is retried only when it wasn't sent (connect errors), after
+        # a read timeout or a 5xx jenkins may have queued the build already
+        retry = Retry(total=retries, connect=retries, read=retries,
+                      status=retries, backoff_factor=backoff,
+                      status_forcelist=RETRY_STATUS_CODES,
+                      allowed_methods=RETRY_METHODS,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        # jenkins root url -> crumb header or None if CSRF is disabled
+        self._crumbs = {}
+        self._crumb_lock = threading.Lock()
+        # (url, params) -> ETag, Last-Modified and JSON of the last response
+        self._json_cache = {}
+
+    @classmethod
+    def from_config(cls, config_data):
+        return cls(
+            connect_timeout=config_data.get('JENKINS_CONNECT_TIMEOUT',
+                                            JENKINS_CONNECT_TIMEOUT),
+            read_timeout=config_data.get('JENKINS_READ_TIMEOUT',
+                                         JENKINS_READ_TIMEOUT),
+            retries=config_data.get('JENKINS_RETRIES', JENKINS_RETRIES),
+            backoff=config_data.get('JENKINS_BACKOFF', JENKINS_BACKOFF),
+            pool_size=config_data.get('JENKINS_POOL_SIZE',
+                                      JENKINS_POOL_SIZE))
+
+    @staticmethod
+    def root_url(url):
+        """
+        Jenkins root of a job url, e.g. https://host/ci for
+        https://host/ci/job/DevOps/job/x/buildWithParameters
+        """
+        parts = urlsplit(url)
+        path = parts.path.split('/job/', 1)[0].rstrip('/')
+        return '{}://{}{}'.format(parts.scheme, parts.netloc, path)
+
+    def get_crumb(self, url, refresh=False):
+        """
+        :return: crumb header for the jenkins instance of url, None when
+                 the instance doesn't use CSRF protection
+        :rtype: dict
+        """
+        root = self.root_url(url)
+        with self._crumb_lock:
+            if refresh or root not in self._crumbs:
+                ret = self._session.get(root + '/crumbIssuer/api/json',
+                                        timeout=self._timeout)
+                if ret.status_code == 200:
+                    crumb = ret.json()
+                    self._crumbs[root] = {
+                        crumb['crumbRequestField']: crumb['crumb']}
+                else:
+                    self._crumbs[root] = None
+            return self._crumbs[root]
+
+    def post(self, url, data=None):
+        """
+        POST to jenkins with the cached crumb, a rejected crumb (403) is
+        refreshed and the request is sent once more
+        :return: response of jenkins
+        """
+        with JENKINS_REQUEST_DURATION.labels('POST').time():
+            ret = self._session.post(url, data=data,
+                                     headers=self.get_crumb(url),
+                                     timeout=self._timeout)
+            if ret.status_code == 403:
+                ret = self._session.post(url, data=data,
+                                         headers=self.get_crumb(url, True),
+                                         timeout=self._timeout)
+        JENKINS_RESPONSES.labels('POST', ret.status_code).inc()
+        return ret
+
+    def get(self, url, params=None, headers=None):
+        with JENKINS_REQUEST_DURATION.labels('GET').time():
+            ret = self._session.get(url, params=params, headers=headers,
+                                    timeout=self._timeout)
+        JENKINS_RESPONSES.labels('GET', ret.status_code).inc()
+        return ret
+
+    def get_json(self, url, params=None):
+        """
+        GET a jenkins JSON API url, conditional on the ETag/Last-Modified
+        of the previous response of the same query
+        :return: parsed JSON, the cached one when jenkins answered 304
+        """
+        key = (url, tuple(sorted((params or {}).items())))
+        cached = self._json_cache.get(key)
+        headers = {}
+        if cached:
+            if cached[0]:
+                headers['If-None-Match'] = cached[0]
+            if cached[1]:
+                headers['If-Modified-Since'] = cached[1]
+        ret = self.get(url, params=params, headers=headers)
+        if ret.status_code == 304 and cached:
+            return cached[2]
+        ret.raise_for_status()
+        data = ret.json()
+        self._json_cache[key] = (ret.headers.get('ETag'),
+                                 ret.headers.get('Last-Modified'), data)
+        return data
+
+    def close(self):
+        self._session.close()
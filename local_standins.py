@@ -0,0 +1,160 @@
+""" Local stand-ins for Jenkins and Slack used by benchmarks and tests """
+
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class JenkinsStandIn:
+    """
+    Purpose: Minimal HTTP server answering like jenkins. buildWithParameters
+    calls are recorded and answered with 201, crumbIssuer answers 404 (CSRF
+    disabled) and POSTs to response_url record the slack follow-ups.
+    <job>/api/json lists the recorded builds of the job, newest first, with
+    an ETag, their result is set through finish_build.
+    """
+
+    RESPONSE_PATH = '/slack/response'
+
+    def __init__(self, latency=0.0, status_code=201, port=0):
+        self.latency = latency
+        self.status_code = status_code
+        self.builds = []
+        self.responses = []
+        self.api_requests = 0
+        # job path -> build records in the jenkins JSON API layout
+        self.job_builds = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port),
+                                           self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self._server.server_address)
+
+    @property
+    def response_url(self):
+        return self.url + self.RESPONSE_PATH
+
+    def job_url(self, job_name):
+        return '{}/job/{}/buildWithParameters'.format(self.url, job_name)
+
+    def finish_build(self, job_name, cluster_name, result):
+        """
+        Complete the newest build of the job for the cluster
+        """
+        with self._lock:
+            for build in self.job_builds.get('/job/' + job_name, []):
+                parameters = build['actions'][0]['parameters']
+                if {'name': 'AWS_CLUSTER_NAME',
+                        'value': cluster_name} in parameters:
+                    build['building'] = False
+                    build['result'] = result
+                    return build
+        return None
+
+    def _add_build(self, job_path, params):
+        builds = self.job_builds.setdefault(job_path, [])
+        builds.insert(0, {
+            'number': len(builds) + 1, 'building': True, 'result': None,
+            'timestamp': int(time.time() * 1000),
+            'actions': [{'parameters': [
+                {'name': name, 'value': value}
+                for name, value in sorted(params.items())]}]})
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True, name='jenkins-standin')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length', 0))
+                return self.rfile.read(length).decode('utf-8')
+
+            def _reply(self, status_code, body=b'', headers=None):
+                self.send_response(status_code)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                if not path.endswith('/api/json') or '/job/' not in path:
+                    self._reply(404)
+                    return
+                # the tree filter isn't applied, the records only have
+                # the fields the reconciler asks for
+                with standin._lock:
+                    standin.api_requests += 1
+                    body = json.dumps({'builds': standin.job_builds.get(
+                        path[:-len('/api/json')], [])}).encode('utf-8')
+                etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    self._reply(304, headers={'ETag': etag})
+                else:
+                    self._reply(200, body, {'ETag': etag,
+                                            'Content-Type':
+                                                'application/json'})
+
+            def do_POST(self):
+                path = urlsplit(self.path).path
+                body = self._body()
+                if standin.latency:
+                    time.sleep(standin.latency)
+                if path == standin.RESPONSE_PATH:
+                    with standin._lock:
+                        standin.responses.append(json.loads(body or '{}'))
+                    self._reply(200)
+                elif path.endswith('/buildWithParameters'):
+                    params = {key: value[0] for key, value in
+                              parse_qs(body).items()}
+                    with standin._lock:
+                        standin.builds.append((path, params))
+                        if standin.status_code == 201:
+                            standin._add_build(
+                                path[:-len('/buildWithParameters')], params)
+                    self._reply(standin.status_code)
+                else:
+                    self._reply(404)
+
+        return Handler
+
+
+class SlackClientStandIn:
+    """
+    Purpose: Stand-in of slack_sdk WebClient recording posted messages
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = []
+        self.latencies = []
+
+    def chat_postMessage(self, channel, text, **kwargs):
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        self.messages.append((channel, text))
+        self.latencies.append(time.perf_counter() - start)
+        return {'ok': True, 'channel': channel}
@@ -0,0 +1,223 @@
+""" In-process metrics exposed in the prometheus text format """
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """
+        :return: all metrics in the prometheus text exposition format
+        :rtype: str
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name,
+                                               metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append('{}="{}"'.format(*extra))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    Purpose: Base of the metric types, one child per label value tuple.
+    Updating a child costs a dict lookup and a short lock.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(),
+                 registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        registry.register(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{} expects labels {}'.format(
+                    self.name, self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield '{}_total{} {}'.format(
+                self.name, _format_labels(self.labelnames, values),
+                _format_value(child.value))
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(self.labelnames, values,
+                                   ('le', _format_value(bound))),
+                    cumulative)
+            labels = _format_labels(self.labelnames, values)
+            yield '{}_sum{} {}'.format(self.name, labels, repr(total))
+            yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+
+SLACK_COMMAND_DURATION = Histogram(
+    'slack_command_duration_seconds',
+    'Time to answer a slack slash command request', ['command'])
+UPDATE_CALLBACK_DURATION = Histogram(
+    'update_callback_duration_seconds',
+    'Time to handle a jenkins /update callback')
+UPDATE_BATCH_DURATION = Histogram(
+    'update_batch_duration_seconds',
+    'Time to handle a jenkins /update/batch request')
+UPDATE_BATCH_SIZE = Histogram(
+    'update_batch_size', 'Updates per /update/batch request',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+JENKINS_REQUEST_DURATION = Histogram(
+    'jenkins_request_duration_seconds',
+    'Latency of jenkins REST calls including retries', ['method'])
+JENKINS_RESPONSES = Counter(
+    'jenkins_responses', 'Jenkins responses by status code',
+    ['method', 'status_code'])
+DB_PERSIST_DURATION = Histogram(
+    'db_persist_duration_seconds',
+    'Time to persist a change of the cluster db', ['backend', 'phase'])
+DB_PERSIST_BYTES = Counter(
+    'db_persist_bytes', 'Bytes written to persist the cluster db',
+    ['backend'])
+EXPIRY_SCAN_DURATION = Histogram(
+    'expiry_scan_duration_seconds', 'Time to query the expiring clusters')
+SUBPROCESS_DURATION = Histogram(
+    'subprocess_duration_seconds', 'Execution time of shell commands',
+    ['command'], buckets=DEFAULT_BUCKETS + (120.0, 300.0))
+DUPLICATE_REQUESTS = Counter(
+    'duplicate_requests', 'Retried or repeated requests answered from the '
+    'idempotency cache', ['endpoint'])
+SHELL_SESSION_SPAWNS = Counter(
+    'shell_session_spawns', 'Shell sessions spawned by the session pool')
+SLACK_API_DURATION = Histogram(
+    'slack_api_duration_seconds', 'Latency of slack web API calls',
+    ['method'])
+SLACK_API_ERRORS = Counter(
+    'slack_api_errors', 'Failed slack web API calls',
+    ['method', 'status_code'])
+
+
+def render():
+    return REGISTRY.render()
@@ -1,7 +1,385 @@
+import atexit
+import os
+import queue
+import shlex
+import signal
 import subprocess
 import sys
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from metrics import SHELL_SESSION_SPAWNS, SUBPROCESS_DURATION
 
 SUBPROCESS_TIMEOUT = 60
+FAN_OUT_WORKERS = 16
+TAIL_LINES = 200
+MAX_LOGGED_OUTPUT = 4096
+STREAM_BUFFER_LINES = 1000
+SESSION_IDLE_TTL = 300
+SESSION_SPAWN_TIMEOUT = 120
+SESSION_CLOSE_TIMEOUT = 10
+
+
+def truncate_output(output, limit=MAX_LOGGED_OUTPUT):
+    """
+    @return output cut down to its head and tail when longer than limit,
+            used to keep command output out of the logs
+    """
+    if output is None or len(output) <= limit:
+        return output
+    half = limit // 2
+    return '{}\n... {} characters truncated ...\n{}'.format(
+        output[:half], len(output) - 2 * half, output[-half:])
+
+
+class ProcessResult():
+    """
+    Purpose: Outcome of a command executed by fan_out_exec_process
+    """
+
+    def __init__(self, target, cmd, expected_return_code=0):
+        self.target = target
+        self.cmd = cmd
+        self.expected_return_code = expected_return_code
+        self.stdout = ''
+        self.stderr = ''
+        self.return_code = None
+        self.duration = 0.0
+        self.timed_out = False
+        self.cancelled = False
+        self.error = None
+
+    @property
+    def succeeded(self):
+        return (not self.timed_out and not self.cancelled and
+                self.error is None and
+                self.return_code == self.expected_return_code)
+
+    def __repr__(self):
+        return ('ProcessResult(target={!r}, return_code={}, duration={:.3f}, '
+                'timed_out={}, cancelled={}, error={!r})'.format(
+                    self.target, self.return_code, self.duration,
+                    self.timed_out, self.cancelled, self.error))
+
+
+class ProcessStream():
+    """
+    Purpose: Output of a running command, read line by line. Iterating
+    yields the decoded stdout lines as they are produced, only the last
+    tail_lines lines of stdout and stderr are kept. After the iteration
+    return_code and timed_out are set, a stream left early kills the
+    command.
+    """
+
+    def __init__(self, cmd, input_cmd=None, timeout=SUBPROCESS_TIMEOUT,
+                 callback=None, tail_lines=TAIL_LINES):
+        self.cmd = cmd
+        self.input_cmd = input_cmd
+        self.timeout = timeout
+        self.callback = callback
+        self.stdout_tail = deque(maxlen=tail_lines)
+        self.stderr_tail = deque(maxlen=tail_lines)
+        self.line_count = 0
+        self.return_code = None
+        self.timed_out = False
+        self.duration = 0.0
+
+    @property
+    def stdout(self):
+        return '\n'.join(self.stdout_tail)
+
+    @property
+    def stderr(self):
+        return '\n'.join(self.stderr_tail)
+
+    @staticmethod
+    def _decode(line):
+        return line.decode('utf-8', errors='replace').rstrip('\r\n')
+
+    def _read_stdout(self, pipe, lines):
+        # the bounded queue makes the reader wait for a slow consumer
+        # instead of buffering the whole output
+        for line in pipe:
+            lines.put(line)
+        lines.put(None)
+
+    def _read_stderr(self, pipe):
+        for line in pipe:
+            self.stderr_tail.append(self._decode(line))
+
+    def _write_stdin(self, pipe):
+        try:
+            pipe.write(bytes("\n".join(self.input_cmd) + '\n', 'utf-8'))
+            pipe.close()
+        except OSError:
+            pass
+
+    def __iter__(self):
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.timeout
+        process = subprocess.Popen(
+            self.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE if self.input_cmd is not None else None,
+            start_new_session=True)
+        lines = queue.Queue(maxsize=STREAM_BUFFER_LINES)
+        threads = [threading.Thread(target=self._read_stdout,
+                                    args=(process.stdout, lines), daemon=True),
+                   threading.Thread(target=self._read_stderr,
+                                    args=(process.stderr,), daemon=True)]
+        if self.input_cmd is not None:
+            threads.append(threading.Thread(target=self._write_stdin,
+                                            args=(process.stdin,),
+                                            daemon=True))
+        for thread in threads:
+            thread.start()
+        finished = False
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise queue.Empty
+                line = lines.get(timeout=remaining)
+                if line is None:
+                    break
+                line = self._decode(line)
+                self.stdout_tail.append(line)
+                self.line_count += 1
+                if self.callback is not None:
+                    self.callback(line)
+                yield line
+            finished = True
+        except queue.Empty:
+            self.timed_out = True
+        finally:
+            if not finished:
+                SubprocessExecution._kill_process_group(process)
+                # unblock the stdout reader until it saw the closed pipe
+                while threads[0].is_alive():
+                    try:
+                        lines.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            self.return_code = process.wait()
+            for thread in threads:
+                thread.join()
+            process.stdout.close()
+            process.stderr.close()
+            self.duration = time.perf_counter() - start
+            SubprocessExecution._observe_duration(self.cmd, start)
+
+
+class ShellSession():
+    """
+    Purpose: Long-lived shell, e.g. an oc debug node shell, running
+    successive command batches over the same stdin/stdout. Each batch is
+    followed by a sentinel line on stdout and stderr, the stdout one
+    carries the exit code of the last command of the batch.
+    """
+
+    def __init__(self, cmd, setup_cmd=None):
+        self.cmd = cmd
+        self.setup_cmd = setup_cmd
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self._process = None
+        self._stdout = None
+        self._stderr = None
+
+    @property
+    def alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self, timeout=SESSION_SPAWN_TIMEOUT):
+        """
+        Spawn the shell and run the setup commands (e.g. chroot /host),
+        returns once the shell answered the first sentinel
+        """
+        self._process = subprocess.Popen(
+            self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, start_new_session=True)
+        self._stdout = queue.Queue()
+        self._stderr = queue.Queue()
+        for pipe, lines in ((self._process.stdout, self._stdout),
+                            (self._process.stderr, self._stderr)):
+            threading.Thread(target=self._read, args=(pipe, lines),
+                             daemon=True).start()
+        result = self.run(self.setup_cmd or [], timeout)
+        if not result.succeeded:
+            self.close()
+            raise RuntimeError('{} failed to start: {}'.format(
+                self.cmd, result.error or truncate_output(result.stderr)))
+
+    @staticmethod
+    def _read(pipe, lines):
+        for line in pipe:
+            lines.put(line)
+        lines.put(None)
+
+    @staticmethod
+    def _read_batch(lines, token, deadline):
+        """
+        @return output lines up to the sentinel and the text following the
+                sentinel, None instead when the shell exited or the
+                deadline passed
+        """
+        output = []
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                line = lines.get(timeout=remaining) if remaining > 0 \
+                    else lines.get_nowait()
+            except queue.Empty:
+                return output, None
+            if line is None:
+                return output, None
+            head, sep, tail = line.decode(
+                'utf-8', errors='replace').partition(token)
+            if sep:
+                # output without a trailing newline precedes the sentinel
+                if head:
+                    output.append(head)
+                return output, tail.strip()
+            output.append(head)
+
+    def run(self, commands, timeout=SUBPROCESS_TIMEOUT,
+            expected_return_code=0):
+        """
+        @return ProcessResult of the batch, return_code is the exit code of
+                its last command. A batch which timed out kills the shell,
+                its output read up to then is kept.
+        """
+        token = '__session_done_{}__'.format(uuid.uuid4().hex)
+        script = list(commands) + [
+            "__rc=$?; printf '%s %s\\n' {0} \"$__rc\"; "
+            "printf '%s\\n' {0} >&2".format(token)]
+        result = ProcessResult(None, self.cmd, expected_return_code)
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        try:
+            self._process.stdin.write(bytes('\n'.join(script) + '\n',
+                                            'utf-8'))
+            self._process.stdin.flush()
+        except OSError as e:
+            result.error = str(e)
+            self.close(kill=True)
+            return result
+        stdout, return_code = self._read_batch(self._stdout, token, deadline)
+        stderr, marker = (self._read_batch(self._stderr, token, deadline)
+                          if return_code is not None else ([], None))
+        result.stdout = ''.join(stdout)
+        result.stderr = ''.join(stderr)
+        result.duration = time.perf_counter() - start
+        self.last_used = time.monotonic()
+        if return_code is None or marker is None:
+            if self.alive:
+                result.timed_out = True
+            else:
+                result.error = 'shell exited with {}'.format(
+                    self._process.returncode)
+            self.close(kill=True)
+        else:
+            result.return_code = int(return_code)
+        return result
+
+    def close(self, kill=False):
+        """
+        Exit the shell, an oc debug shell removes its debug pod on exit
+        """
+        process, self._process = self._process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=0 if kill else SESSION_CLOSE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            SubprocessExecution._kill_process_group(process)
+            process.wait()
+
+
+class ShellSessionPool():
+    """
+    Purpose: Shell sessions kept alive per command, e.g. one oc debug
+    shell per node, so repeated inspections of a node skip the debug pod
+    startup. A dead session is respawned on its next use and sessions
+    idle for longer than idle_ttl are closed by a reaper thread.
+    """
+
+    def __init__(self, idle_ttl=SESSION_IDLE_TTL,
+                 spawn_timeout=SESSION_SPAWN_TIMEOUT):
+        self._idle_ttl = idle_ttl
+        self._spawn_timeout = spawn_timeout
+        # (cmd, setup_cmd) -> ShellSession
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._reaper = None
+
+    def run(self, cmd, commands, setup_cmd=None, timeout=SUBPROCESS_TIMEOUT,
+            expected_return_code=0):
+        """
+        Run a batch of commands in the session of cmd, batches for the
+        same session are executed one at a time
+        :return: ProcessResult of the batch
+        """
+        key = (tuple(cmd), tuple(setup_cmd or ()))
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = ShellSession(cmd, setup_cmd)
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap,
+                                                daemon=True,
+                                                name='shell-session-reaper')
+                self._reaper.start()
+        with session.lock:
+            if not session.alive:
+                SHELL_SESSION_SPAWNS.inc()
+                session.start(self._spawn_timeout)
+            return session.run(commands, timeout, expected_return_code)
+
+    def size(self):
+        with self._lock:
+            return sum(1 for session in self._sessions.values()
+                       if session.alive)
+
+    def _reap(self):
+        while not self._stopped.wait(max(self._idle_ttl / 2, 1)):
+            self.reap_idle()
+
+    def reap_idle(self):
+        """
+        Close the sessions which weren't used for idle_ttl, sessions
+        running a batch are skipped
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            if not session.lock.acquire(blocking=False):
+                continue
+            try:
+                if time.monotonic() - session.last_used >= self._idle_ttl:
+                    session.close()
+            finally:
+                session.lock.release()
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            with session.lock:
+                session.close()
+
+
+SESSION_POOL = ShellSessionPool()
+atexit.register(SESSION_POOL.close)
 
 
 class SubprocessExecution():
@@ -9,9 +387,10 @@ class SubprocessExecution():
     Purpose: Class to perform shell command execution using subprocess
     """
 
-    def __init__(self, log):
+    def __init__(self, log, session_pool=SESSION_POOL):
         self.log = log
         self.std_error = ''
+        self.session_pool = session_pool
 
     def exec_process(self, cmd, timeout=SUBPROCESS_TIMEOUT,
                      expected_return_code=0, print_stdout=True):
@@ -32,8 +411,8 @@ class SubprocessExecution():
                 None upon cmd execution failure
                 :param return_code:
         """
-        self.log.info("Executing in {} ".format(sys._getframe(
-            1).f_code.co_name))
+        self.log.info("Executing in %s", sys._getframe(1).f_code.co_name)
+        start = time.perf_counter()
         try:
             process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                        stderr=subprocess.PIPE)
@@ -42,33 +421,38 @@ class SubprocessExecution():
 
             stdout, stderr = process.communicate(timeout=timeout)
             return_code = process.returncode
+            self._observe_duration(cmd, start)
 
             if stderr:
                 self.std_error = stderr.decode('utf-8')
-                self.log.info('stdout %s', stdout)
+                self.log.info('stdout %s', truncate_output(stdout))
             if stderr and not return_code and not stdout:
                 raise subprocess.CalledProcessError(return_code, cmd, stderr)
             if return_code != expected_return_code:
-                self.log.info('returned code: {}, expected return code: {}'
-                              ''.format(return_code, expected_return_code))
+                self.log.info('returned code: %s, expected return code: %s',
+                              return_code, expected_return_code)
                 raise Exception(
                     "{} failed with error {} and the output is {}".format(
-                        cmd[0] + cmd[1], stderr, stdout))
+                        cmd[0] + cmd[1], truncate_output(stderr),
+                        truncate_output(stdout)))
+            output = stdout.decode("utf-8")
             if print_stdout:
-                self.log.info("Command executed: {} Result of the command: "
-                              "{}".format(cmd, stdout.decode("utf-8")))
-            return stdout.decode("utf-8")
+                self.log.info("Command executed: %s Result of the command: "
+                              "%s", cmd, truncate_output(output))
+            return output
         except subprocess.TimeoutExpired:
             process.kill()
             stdout, stderr = process.communicate()
-            self.log.info("{} execution timedout with stdout {} and stderr {}"
-                          "".format(cmd, stdout, stderr))
+            self._observe_duration(cmd, start)
+            self.log.info("%s execution timedout with stdout %s and stderr %s",
+                          cmd, truncate_output(stdout),
+                          truncate_output(stderr))
         except subprocess.CalledProcessError as e:
-            self.log.error("{} execution failed with STDERR {} and Exception "
-                           "{} ".format(cmd, stderr, str(e)))
+            self.log.error("%s execution failed with STDERR %s and Exception "
+                           "%s ", cmd, truncate_output(stderr), e)
         except Exception as e:
-            self.log.error("{} exception raised while executing command {} "
-                           "".format(str(e), cmd))
+            self.log.error("%s exception raised while executing command %s ",
+                           e, cmd)
         return None
 
     def nested_exec_process(self, cmd, input_cmd, timeout=SUBPROCESS_TIMEOUT,
@@ -104,8 +488,8 @@ class SubprocessExecution():
         self.nested_exec_process(
                 cmd, input_cmd, expected_return_code=return_code)
         """
-        self.log.info("Executing in {} ".format(sys._getframe(
-            1).f_code.co_name))
+        self.log.info("Executing in %s", sys._getframe(1).f_code.co_name)
+        start = time.perf_counter()
         try:
             process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
                                        stdout=subprocess.PIPE,
@@ -117,24 +501,267 @@ class SubprocessExecution():
             stdout, stderr = process.communicate(input=input_cmd,
                                                  timeout=timeout)
             return_code = process.returncode
+            self._observe_duration(cmd, start)
             if return_code != expected_return_code:
-                self.log.info('returned code: {}, expected return code: {}'
-                              ''.format(return_code, expected_return_code))
+                self.log.info('returned code: %s, expected return code: %s',
+                              return_code, expected_return_code)
                 raise Exception(
                     "{} failed with error {} and the output is {}".format(
-                        cmd[0] + cmd[1], stderr, stdout))
-            self.log.info("Command executed: {} Result of the command: "
-                          "{}".format(cmd, stdout.decode("utf-8")))
-            return stdout.decode("utf-8")
+                        cmd[0] + cmd[1], truncate_output(stderr),
+                        truncate_output(stdout)))
+            output = stdout.decode("utf-8")
+            self.log.info("Command executed: %s Result of the command: %s",
+                          cmd, truncate_output(output))
+            return output
         except subprocess.TimeoutExpired:
             process.kill()
             stdout, stderr = process.communicate()
-            self.log.info("{} execution timedout with stdout {} and stderr {}"
-                          "".format(cmd, stdout, stderr))
+            self._observe_duration(cmd, start)
+            self.log.info("%s execution timedout with stdout %s and stderr %s",
+                          cmd, truncate_output(stdout),
+                          truncate_output(stderr))
         except Exception as e:
-            self.log.error("{} exception raised while executing command {} "
-                           "".format(str(e), cmd))
+            self.log.error("%s exception raised while executing command %s ",
+                           e, cmd)
         return None
 
+    def session_exec_process(self, cmd, input_cmd, setup_cmd=None,
+                             timeout=SUBPROCESS_TIMEOUT,
+                             expected_return_code=0):
+        """"
+        Objective: Execute nested cmds like nested_exec_process, in a
+        shell of the parent command which is kept alive between calls.
+
+        @param cmd: List of strings / parent command, its session is reused
+            by later calls with the same cmd and setup_cmd
+        @param input_cmd: list of nested commands to be executed in the
+            session
+        @param setup_cmd: list of commands executed once when the session
+            is spawned, e.g. switching into the shell the nested commands
+            run in
+        @param timeout: a batch running longer kills the session, it is
+            respawned on the next call
+        @param expected_return_code: expected return code of the last
+            nested command
+
+        @return command output in 'utf-8' format upon success
+                None upon cmd execution failure
+        for example : repeated inspections of a node share one debug pod
+         cmd = shlex.split('oc debug node/' + hostname)
+         self.session_exec_process(
+             cmd, ['grep pids_limit /etc/crio/crio.conf | cut -d"=" -f2-'],
+             setup_cmd=['chroot /host'])
+        """
+        self.log.info("Executing in %s", sys._getframe(1).f_code.co_name)
+        start = time.perf_counter()
+        try:
+            result = self.session_pool.run(cmd, input_cmd, setup_cmd,
+                                           timeout, expected_return_code)
+        except Exception as e:
+            self.log.error("%s exception raised while executing command %s ",
+                           e, cmd)
+            return None
+        self._observe_duration(cmd, start)
+        if result.stderr:
+            self.std_error = result.stderr
+        if result.timed_out or result.error is not None:
+            self.log.info("%s execution timedout or failed (%s) with stdout "
+                          "%s and stderr %s", cmd, result.error,
+                          truncate_output(result.stdout),
+                          truncate_output(result.stderr))
+            return None
+        if not result.succeeded:
+            self.log.info('returned code: %s, expected return code: %s, '
+                          'stderr %s', result.return_code,
+                          expected_return_code,
+                          truncate_output(result.stderr))
+            return None
+        self.log.info("Command executed: %s Result of the command: %s",
+                      cmd, truncate_output(result.stdout))
+        return result.stdout
+
+    def stream_process(self, cmd, input_cmd=None, timeout=SUBPROCESS_TIMEOUT,
+                       callback=None, tail_lines=TAIL_LINES):
+        """
+        Objective: Execute a command with a large output without holding
+        the output in memory.
+
+        @param cmd: List of strings
+        @param input_cmd: list of nested commands written to stdin, as in
+            nested_exec_process
+        @param timeout: the command is killed when it runs longer, the
+            lines read up to then are still yielded
+        @param callback: called with every decoded stdout line
+        @param tail_lines: number of last stdout/stderr lines kept
+
+        @return ProcessStream, iterate it for the stdout lines
+        for example : filter the pods of a cluster while they are listed
+         stream = self.stream_process(shlex.split('oc get pods -A'))
+         pending = [line for line in stream if 'Pending' in line]
+         if stream.return_code != 0:
+             self.log.error('oc failed: %s', stream.stderr)
+        """
+        self.log.info("Executing in %s", sys._getframe(1).f_code.co_name)
+        return ProcessStream(cmd, input_cmd=input_cmd, timeout=timeout,
+                             callback=callback, tail_lines=tail_lines)
+
+    def exec_process_streaming(self, cmd, input_cmd=None,
+                               timeout=SUBPROCESS_TIMEOUT,
+                               expected_return_code=0, callback=None,
+                               tail_lines=TAIL_LINES):
+        """
+        Objective: Execute a command, handing its output to callback line
+        by line, with memory bound by tail_lines.
+
+        @return ProcessResult with the last tail_lines lines of stdout and
+                stderr, on timeout the output read up to then and
+                timed_out set
+        """
+        self.log.info("Executing in %s", sys._getframe(1).f_code.co_name)
+        result = ProcessResult(None, cmd, expected_return_code)
+        stream = ProcessStream(cmd, input_cmd=input_cmd, timeout=timeout,
+                               callback=callback, tail_lines=tail_lines)
+        try:
+            for _ in stream:
+                pass
+        except OSError as e:
+            result.error = str(e)
+            self.log.error("%s exception raised while executing command %s ",
+                           e, cmd)
+            return result
+        result.stdout = stream.stdout
+        result.stderr = stream.stderr
+        result.return_code = stream.return_code
+        result.timed_out = stream.timed_out
+        result.duration = stream.duration
+        if result.stderr:
+            self.std_error = result.stderr
+        if stream.timed_out:
+            self.log.info("%s execution timedout after %s lines with stdout "
+                          "%s and stderr %s", cmd, stream.line_count,
+                          truncate_output(result.stdout),
+                          truncate_output(result.stderr))
+        elif not result.succeeded:
+            self.log.info('returned code: %s, expected return code: %s, '
+                          'stderr %s', result.return_code,
+                          expected_return_code,
+                          truncate_output(result.stderr))
+        else:
+            self.log.info("Command executed: %s with %s lines of output",
+                          cmd, stream.line_count)
+        return result
+
+    def fan_out_exec_process(self, tasks, input_cmd=None,
+                             timeout=SUBPROCESS_TIMEOUT, global_timeout=None,
+                             expected_return_code=0,
+                             max_workers=FAN_OUT_WORKERS):
+        """
+        Objective: Execute many commands concurrently on a bounded pool,
+        e.g. the same checks on every node of a cluster.
+
+        @param tasks: dict of target -> command (list of strings)
+        @param input_cmd: list of nested commands written to the stdin of
+            every command, as in nested_exec_process
+        @param timeout: per command timeout, a command running longer is
+            killed and its result is marked timed_out
+        @param global_timeout: deadline for the whole fan-out, commands
+            still running then are killed and commands which didn't start
+            are cancelled
+        @param expected_return_code: return code a succeeded command has
+        @param max_workers: maximum number of concurrently running commands
+
+        @return dict of target -> ProcessResult in the order of tasks
+        for example : node checks across a cluster
+         tasks = self.node_debug_tasks(hostnames)
+         results = self.fan_out_exec_process(
+             tasks, ['chroot /host', 'cat /etc/crio/crio.conf'],
+             global_timeout=300)
+         failed = [r.target for r in results.values() if not r.succeeded]
+        """
+        self.log.info("Executing %s commands in %s", len(tasks),
+                      sys._getframe(1).f_code.co_name)
+        deadline = (time.monotonic() + global_timeout
+                    if global_timeout is not None else None)
+        if input_cmd is not None:
+            input_cmd = bytes("\n".join(input_cmd) + '\n', 'utf-8')
+        results = {target: ProcessResult(target, cmd, expected_return_code)
+                   for target, cmd in tasks.items()}
+        cancelled = threading.Event()
+        with ThreadPoolExecutor(max_workers=max(1, min(
+                max_workers, len(tasks)))) as executor:
+            futures = [executor.submit(self._run_fan_out_task,
+                                       results[target], input_cmd, timeout,
+                                       deadline, cancelled)
+                       for target in tasks]
+            wait(futures, timeout=global_timeout)
+            if deadline is not None and time.monotonic() >= deadline:
+                # running commands are bound to the deadline by their own
+                # timeout, the ones not started yet are dropped
+                cancelled.set()
+                for future in futures:
+                    future.cancel()
+        for result in results.values():
+            if result.return_code is None and not result.timed_out and \
+                    result.error is None:
+                result.cancelled = True
+        failed = [target for target, result in results.items()
+                  if not result.succeeded]
+        if failed:
+            self.log.info("%s of %s commands failed: %s", len(failed),
+                          len(results), failed)
+        return results
+
+    def _run_fan_out_task(self, result, input_cmd, timeout, deadline,
+                          cancelled):
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        if cancelled.is_set() or timeout <= 0:
+            result.cancelled = True
+            return result
+        start = time.perf_counter()
+        try:
+            # own process group, so a timeout kills the children too
+            process = subprocess.Popen(
+                result.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                stdin=subprocess.PIPE if input_cmd is not None else None,
+                start_new_session=True)
+        except OSError as e:
+            result.error = str(e)
+            return result
+        try:
+            stdout, stderr = process.communicate(input=input_cmd,
+                                                 timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self._kill_process_group(process)
+            stdout, stderr = process.communicate()
+            result.timed_out = True
+        result.duration = time.perf_counter() - start
+        self._observe_duration(result.cmd, start)
+        result.return_code = process.returncode
+        result.stdout = stdout.decode('utf-8', errors='replace')
+        result.stderr = stderr.decode('utf-8', errors='replace')
+        return result
+
+    @staticmethod
+    def _kill_process_group(process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            process.kill()
+
+    @staticmethod
+    def node_debug_tasks(hostnames):
+        """
+        @return dict of hostname -> oc debug command of the node, to be used
+                with fan_out_exec_process
+        """
+        return {hostname: shlex.split('oc debug node/' + hostname)
+                for hostname in hostnames}
+
+    @staticmethod
+    def _observe_duration(cmd, start):
+        SUBPROCESS_DURATION.labels(os.path.basename(cmd[0])).observe(
+            time.perf_counter() - start)
+
     def get_stderror_op(self):
         return self.std_error
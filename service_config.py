@@ -0,0 +1,132 @@
+""" Cached, validated service configuration with hot reload """
+
+import json
+import logging
+import os
+import threading
+import time
+
+from dotenv import dotenv_values
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = 'config.json'
+ENV_PATH = '.env'
+# the files are stat'ed at most this often
+CHECK_INTERVAL = 1.0
+# config key -> expected type(s)
+REQUIRED_KEYS = {
+    'SLACK_CHANNEL': str,
+    'CLOUD_TYPE': list,
+    'CLOUD_REGION': list,
+    'CLUSTER_EXPIRATION_DURATION': (int, float),
+    'JENKINS_AWS_CREATE': str,
+    'JENKINS_AWS_DELETE': str,
+}
+
+
+def validate_config(config_data):
+    """
+    Raise ValueError naming every missing or mistyped key of config_data
+    """
+    if not isinstance(config_data, dict):
+        raise ValueError('config must be a JSON object')
+    errors = []
+    for key, types in REQUIRED_KEYS.items():
+        if key not in config_data:
+            errors.append('{} is missing'.format(key))
+        elif not isinstance(config_data[key], types):
+            errors.append('{} has the wrong type {}'.format(
+                key, type(config_data[key]).__name__))
+    if errors:
+        raise ValueError('invalid config: {}'.format(', '.join(errors)))
+
+
+class ConfigCache:
+    """
+    Purpose: config.json and .env are loaded and validated once and
+    reloaded only when their mtime changed. An invalid config.json is
+    logged and the last valid config stays in use. Variables from .env
+    don't override the environment, except for the ones changed in .env
+    after the first load.
+    """
+
+    def __init__(self, config_path=CONFIG_PATH, env_path=ENV_PATH,
+                 check_interval=CHECK_INTERVAL):
+        self.config_path = config_path
+        self.env_path = env_path
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._config = None
+        self._env = {}
+        self._mtimes = (None, None)
+        self._checked = 0
+        self._listeners = []
+
+    def on_change(self, callback):
+        """
+        :param callback: called with the config after every reload
+        """
+        self._listeners.append(callback)
+
+    def get(self):
+        """
+        :return: current config, raises ValueError/OSError when the first
+                 load fails
+        :rtype: dict
+        """
+        if self._config is not None and \
+                time.monotonic() - self._checked < self._check_interval:
+            return self._config
+        with self._lock:
+            if self._config is not None and \
+                    time.monotonic() - self._checked < self._check_interval:
+                return self._config
+            changed = self._reload()
+            self._checked = time.monotonic()
+            config_data = self._config
+        if changed:
+            for callback in self._listeners:
+                try:
+                    callback(config_data)
+                except Exception as e:
+                    logger.error('Exception found: %s', e)
+        return config_data
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns if path else None
+        except FileNotFoundError:
+            return None
+
+    def _reload(self):
+        mtimes = (self._mtime(self.config_path), self._mtime(self.env_path))
+        if self._config is not None and mtimes == self._mtimes:
+            return False
+        if mtimes[1] != self._mtimes[1] and mtimes[1] is not None:
+            self._load_env()
+        if self._config is None or mtimes[0] != self._mtimes[0]:
+            try:
+                with open(self.config_path) as fp:
+                    config_data = json.load(fp)
+                validate_config(config_data)
+                self._config = config_data
+            except (OSError, ValueError) as e:
+                if self._config is None:
+                    raise
+                logger.error('keeping the last valid config, %s: %s',
+                             self.config_path, e)
+        self._mtimes = mtimes
+        logger.info('loaded %s', self.config_path)
+        return True
+
+    def _load_env(self):
+        values = dotenv_values(self.env_path)
+        for key, value in values.items():
+            if value is None:
+                continue
+            if key not in os.environ or (key in self._env and
+                                         self._env[key] != value):
+                os.environ[key] = value
+        self._env = values
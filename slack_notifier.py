@@ -0,0 +1,144 @@
+""" Non-blocking, rate limit aware slack notifications """
+
+import logging
+import threading
+import time
+
+from slack_sdk.errors import SlackApiError
+
+from metrics import SLACK_API_DURATION, SLACK_API_ERRORS
+
+logger = logging.getLogger(__name__)
+
+COALESCE_WINDOW = 2.0
+MIN_POST_INTERVAL = 1.0
+MAX_BATCH = 20
+MAX_RETRIES = 5
+
+
+class SlackNotifier:
+    """
+    Purpose: Queue outbound slack messages and post them from a background
+    worker, callers never wait on slack I/O. Messages for a channel that
+    arrive within the coalescing window are merged into one message,
+    chat.postMessage is paced per channel (slack allows about one message
+    per second and channel) and a 429 holds back the method for the
+    Retry-After period.
+    """
+
+    def __init__(self, client, coalesce_window=COALESCE_WINDOW,
+                 min_interval=MIN_POST_INTERVAL, max_batch=MAX_BATCH,
+                 max_retries=MAX_RETRIES):
+        self._client = client
+        self._coalesce_window = coalesce_window
+        self._min_interval = min_interval
+        self._max_batch = max_batch
+        self._max_retries = max_retries
+        self._cond = threading.Condition()
+        # channel -> queued texts and the time the oldest one is due
+        self._pending = {}
+        self._due = {}
+        # channel -> earliest time of the next post to it
+        self._next_post = {}
+        # set from Retry-After, applies to chat.postMessage as a whole
+        self._blocked_until = 0
+        self._retries = {}
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, daemon=True,
+                                        name='slack-notifier')
+        self._thread.start()
+
+    def notify(self, channel, text):
+        """
+        Queue a message for the channel and return immediately
+        """
+        with self._cond:
+            if channel not in self._pending:
+                self._pending[channel] = []
+                self._due[channel] = time.monotonic() + self._coalesce_window
+            self._pending[channel].append(text)
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return sum(len(texts) for texts in self._pending.values())
+
+    def _ready_at(self, channel):
+        return max(self._due[channel], self._next_post.get(channel, 0),
+                   self._blocked_until)
+
+    def _next_batch(self):
+        """
+        Wait for the next channel which is due and allowed to be posted to
+        :return: channel and texts to post, None once stopped and drained
+        """
+        with self._cond:
+            while True:
+                if not self._pending:
+                    if self._stopped:
+                        return None
+                    self._cond.wait()
+                    continue
+                channel = min(self._pending, key=self._ready_at)
+                delay = self._ready_at(channel) - time.monotonic()
+                if delay > 0 and not self._stopped:
+                    self._cond.wait(delay)
+                    continue
+                texts = self._pending[channel][:self._max_batch]
+                del self._pending[channel][:self._max_batch]
+                if not self._pending[channel]:
+                    del self._pending[channel]
+                    del self._due[channel]
+                self._next_post[channel] = (time.monotonic() +
+                                            self._min_interval)
+                return channel, texts
+
+    def _requeue(self, channel, texts, retry_after):
+        with self._cond:
+            self._blocked_until = time.monotonic() + retry_after
+            self._pending.setdefault(channel, [])[:0] = texts
+            self._due.setdefault(channel, time.monotonic())
+            self._cond.notify()
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            channel, texts = batch
+            try:
+                with SLACK_API_DURATION.labels('chat.postMessage').time():
+                    self._client.chat_postMessage(channel=channel,
+                                                  text='\n'.join(texts))
+                self._retries.pop(channel, None)
+            except SlackApiError as e:
+                SLACK_API_ERRORS.labels('chat.postMessage',
+                                        e.response.status_code).inc()
+                retries = self._retries.get(channel, 0) + 1
+                if (e.response.status_code == 429 and
+                        retries <= self._max_retries and not self._stopped):
+                    self._retries[channel] = retries
+                    retry_after = int(e.response.headers.get('Retry-After',
+                                                             1))
+                    logger.warning('slack rate limited, retrying in %ss',
+                                   retry_after)
+                    self._requeue(channel, texts, retry_after)
+                else:
+                    self._retries.pop(channel, None)
+                    logger.error('Exception found: %s', e)
+            except Exception as e:
+                logger.error('Exception found: %s', e)
+
+    def stop(self, timeout=None):
+        """
+        Post the queued messages without waiting for the coalescing window
+        and stop the worker
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
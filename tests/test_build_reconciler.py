@@ -0,0 +1,74 @@
+""" BuildReconciler against the jenkins stand-in """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from build_reconciler import BuildReconciler
+from cluster_management import ClusterMgmt
+from cluster_record import ClusterStatus
+from cluster_store import PERSISTENCE_JOURNAL
+from local_standins import JenkinsStandIn
+
+
+class BuildReconcilerTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.jenkins = JenkinsStandIn().start()
+        self.addCleanup(self.jenkins.stop)
+        self.cluster_mgmt = ClusterMgmt(
+            db_path=os.path.join(tmp_dir, 'cluster_info.json'),
+            persistence=PERSISTENCE_JOURNAL)
+        self.addCleanup(self.cluster_mgmt.close)
+        self.cluster_mgmt.set_config_data({
+            'CLOUD_TYPE': ['AWS_ROSA'],
+            'CLOUD_REGION': ['us-east-1'],
+            'CLUSTER_EXPIRATION_DURATION': 2,
+            'JENKINS_AWS_CREATE': self.jenkins.job_url('create'),
+            'JENKINS_AWS_DELETE': self.jenkins.job_url('delete'),
+            'JENKINS_RETRIES': 0})
+        for name in ('a', 'b', 'c', 'd'):
+            self.cluster_mgmt.initiate_cluster_creation(
+                'u1', 'name:{}, type:AWS_ROSA'.format(name))
+
+    def statuses(self):
+        return {cluster.name: cluster.status for cluster in
+                self.cluster_mgmt.get_clusters_by_user('u1')}
+
+    def test_reconcile_applies_finished_builds(self):
+        self.jenkins.finish_build('create', 'a', 'SUCCESS')
+        self.jenkins.finish_build('create', 'b', 'FAILURE')
+        self.cluster_mgmt.delete_cluster('u1', 'c')
+        self.jenkins.finish_build('delete', 'c', 'SUCCESS')
+        # the build of d is still running
+        notified = []
+        reconciler = BuildReconciler(
+            self.cluster_mgmt,
+            on_change=lambda *change: notified.append(change))
+
+        changes = reconciler.reconcile()
+
+        expected = [('u1', 'a', ClusterStatus.RUNNING),
+                    ('u1', 'b', ClusterStatus.FAILED),
+                    ('u1', 'c', ClusterStatus.DELETE_SUCCESS)]
+        self.assertCountEqual(changes, expected)
+        self.assertCountEqual(notified, expected)
+        self.assertEqual(self.statuses(),
+                         {'a': ClusterStatus.RUNNING,
+                          'b': ClusterStatus.FAILED,
+                          'c': ClusterStatus.DELETE_SUCCESS,
+                          'd': ClusterStatus.CREATING})
+        # applied changes aren't reported again
+        self.assertEqual(reconciler.reconcile(), [])
+
+    def test_reconcile_keeps_status_of_running_builds(self):
+        self.assertEqual(BuildReconciler(self.cluster_mgmt).reconcile(), [])
+        self.assertEqual(set(self.statuses().values()),
+                         {ClusterStatus.CREATING})
+
+
+if __name__ == '__main__':
+    unittest.main()
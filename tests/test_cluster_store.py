@@ -0,0 +1,154 @@
+""" Journal recovery and read-only loading of JsonClusterStore """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cluster_store import (PERSISTENCE_JOURNAL, JsonClusterStore,
+                           SqliteClusterStore, import_json_to_sqlite)
+
+
+class JournalReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.db_path = os.path.join(self.tmp_dir, 'cluster_info.json')
+        self.journal_path = self.db_path + '.journal'
+        self.compacting_path = self.journal_path + '.compacting'
+
+    def open_store(self, **kwargs):
+        store = JsonClusterStore(self.db_path, PERSISTENCE_JOURNAL, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def statuses(self, store):
+        return {(user, cluster['name']): cluster['status']
+                for user, clusters in store.snapshot().items()
+                for cluster in clusters}
+
+    def test_replay_after_interrupted_compaction(self):
+        # compacted snapshot in the db file
+        store = self.open_store(compaction_threshold=2)
+        store.update_cluster_info('u1', {'name': 'a', 'status': 'creating'})
+        store.update_cluster_info('u1', {'name': 'b', 'status': 'creating'})
+        store.close()
+        self.assertFalse(os.path.exists(self.compacting_path))
+
+        # changes of a journal whose compaction got interrupted
+        store = self.open_store()
+        store.update_cluster_attribute('u1', {'name': 'a',
+                                              'status': 'running'})
+        store.update_cluster_info('u2', {'name': 'c', 'status': 'creating'})
+        store.close()
+        os.replace(self.journal_path, self.compacting_path)
+
+        # changes of the active journal, on top of the interrupted one
+        store = self.open_store()
+        store.delete_record('u2', 'c')
+        store.update_cluster_attribute('u1', {'name': 'b',
+                                              'status': 'failed'})
+        store.close()
+
+        expected = {('u1', 'a'): 'running', ('u1', 'b'): 'failed'}
+        self.assertEqual(self.statuses(self.open_store()), expected)
+
+        # the next compaction covers both journals
+        store = self.open_store(compaction_threshold=1)
+        store.close()
+        self.assertFalse(os.path.exists(self.compacting_path))
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+        self.assertEqual(self.statuses(self.open_store()), expected)
+
+    def test_replay_skips_torn_last_line(self):
+        store = self.open_store()
+        store.update_cluster_info('u1', {'name': 'a', 'status': 'creating'})
+        store.update_cluster_info('u1', {'name': 'b', 'status': 'creating'})
+        store.close()
+        with open(self.journal_path) as fp:
+            journal = fp.read()
+        # crash in the middle of writing the last entry
+        with open(self.journal_path, 'w') as fp:
+            fp.write(journal[:-15])
+
+        with self.assertLogs('cluster_store', 'WARNING'):
+            store = self.open_store()
+        self.assertEqual(self.statuses(store), {('u1', 'a'): 'creating'})
+
+        # changes after the torn entry survive the next replay
+        store.update_cluster_info('u1', {'name': 'c', 'status': 'creating'})
+        store.close()
+        self.assertEqual(self.statuses(self.open_store()),
+                         {('u1', 'a'): 'creating', ('u1', 'c'): 'creating'})
+
+    def test_replay_skips_garbled_line(self):
+        store = self.open_store()
+        store.update_cluster_info('u1', {'name': 'a', 'status': 'creating'})
+        store.close()
+        with open(self.journal_path, 'a') as fp:
+            fp.write('{"op": "put", "us\n')
+
+        with self.assertLogs('cluster_store', 'WARNING'):
+            store = self.open_store()
+        store.update_cluster_info('u1', {'name': 'b', 'status': 'creating'})
+        store.close()
+
+        # the entries after the garbled one are replayed, it is kept
+        with self.assertLogs('cluster_store', 'WARNING'):
+            store = self.open_store()
+        self.assertEqual(self.statuses(store),
+                         {('u1', 'a'): 'creating', ('u1', 'b'): 'creating'})
+
+    def test_import_leaves_live_journal_alone(self):
+        store = self.open_store()
+        store.update_cluster_info('u1', {'name': 'a', 'status': 'creating'})
+        store.close()
+        entry = ('{"op": "put", "user": "u1", "cluster": '
+                 '{"name": "b", "status": "creating"}}\n')
+        live = open(self.journal_path, 'a')
+        self.addCleanup(live.close)
+        # an append of the live service in progress during the import
+        live.write(entry[:20])
+        live.flush()
+        with open(self.journal_path) as fp:
+            journal = fp.read()
+
+        sqlite_path = os.path.join(self.tmp_dir, 'cluster_info.db')
+        self.assertEqual(import_json_to_sqlite(
+            self.db_path, sqlite_path, PERSISTENCE_JOURNAL), 1)
+        with open(self.journal_path) as fp:
+            self.assertEqual(fp.read(), journal)
+        sqlite_store = SqliteClusterStore(sqlite_path)
+        self.addCleanup(sqlite_store.close)
+        self.assertIsNotNone(sqlite_store.get_cluster('u1', 'a'))
+
+        live.write(entry[20:])
+        live.close()
+        self.assertEqual(self.statuses(self.open_store()),
+                         {('u1', 'a'): 'creating', ('u1', 'b'): 'creating'})
+
+    def test_read_only_store_doesnt_compact(self):
+        store = self.open_store()
+        for name in ('a', 'b', 'c'):
+            store.update_cluster_info('u1', {'name': name,
+                                             'status': 'creating'})
+        store.close()
+        with open(self.journal_path) as fp:
+            journal = fp.read()
+
+        store = self.open_store(compaction_threshold=1, read_only=True)
+        self.assertEqual(len(self.statuses(store)), 3)
+        with self.assertLogs('cluster_store', 'ERROR'):
+            store.update_cluster_info('u1', {'name': 'd',
+                                             'status': 'creating'})
+        store.close()
+
+        self.assertFalse(os.path.exists(self.db_path))
+        self.assertFalse(os.path.exists(self.compacting_path))
+        with open(self.journal_path) as fp:
+            self.assertEqual(fp.read(), journal)
+
+
+if __name__ == '__main__':
+    unittest.main()
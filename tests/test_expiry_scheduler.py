@@ -0,0 +1,43 @@
+""" Warnings of ExpiryScheduler """
+
+import threading
+import time
+import unittest
+
+from expiry_scheduler import ExpiryScheduler
+
+
+class ExpirySchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.announced = []
+        self.expired = threading.Event()
+        self.scheduler = ExpiryScheduler(self.announce, warnings=(24, 1, 0))
+        self.scheduler.start()
+        self.addCleanup(self.scheduler.stop)
+
+    def announce(self, user_name, cluster_name, hours, expiration):
+        self.announced.append((user_name, cluster_name, hours))
+        if not hours:
+            self.expired.set()
+
+    def test_passed_thresholds_are_not_announced(self):
+        # e.g. armed again after a restart, 10 hours before the expiration
+        self.scheduler.arm('u1', 'a', time.time() + 10 * 3600)
+        self.scheduler.arm('u1', 'b', time.time() + 0.2)
+
+        self.assertTrue(self.expired.wait(5))
+        time.sleep(0.1)
+        self.assertEqual(self.announced, [('u1', 'b', 0)])
+
+    def test_rearming_doesnt_repeat_announced_threshold(self):
+        expiration = time.time() + 0.2
+        self.scheduler.arm('u1', 'a', expiration)
+        self.assertTrue(self.expired.wait(5))
+        self.scheduler.arm('u1', 'a', expiration)
+        time.sleep(0.1)
+        self.assertEqual(self.announced, [('u1', 'a', 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
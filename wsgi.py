@@ -0,0 +1,9 @@
+""" WSGI entry point running the service in several worker processes """
+
+# e.g. gunicorn --workers 4 --bind 0.0.0.0:5000 wsgi:app
+# Every worker initializes the service when importing this module, don't
+# preload the app in the master process, its background threads wouldn't
+# survive the fork into the workers.
+from cloud_infra_mgmt_server import create_app
+
+app = create_app(multi_worker=True)